@@ -3,31 +3,72 @@
 
 import flwr as fl
 import boto3
+from botocore.config import Config
 import os
 import requests
 import json
 import logging
 import sys
+import threading
+import time
 
 # Setup logging to stdout
 logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
+NUM_ROUNDS = int(os.getenv('NUM_ROUNDS', '3'))
+# Tries at reading the task metadata before giving up on registration
+METADATA_ATTEMPTS = 5
+
 token = os.getenv('TASK_TOKEN')
 metadata_uri = os.getenv('ECS_CONTAINER_METADATA_URI_V4')
-token_response = ""
-if metadata_uri is not None:
-    r = requests.get(f"{metadata_uri}/task")
-    task_meta = r.json()
-    logger.info(f"found task metadata: {task_meta}")
-    token_response = json.dumps({
-        "ip": task_meta['Containers'][0]['Networks'][0]['IPv4Addresses'][0],
-        "taskArn": task_meta['TaskARN']
-    })
-
-if token is not None:
-    stfn = boto3.client('stepfunctions')
-    logger.info(f"send_task_success - taskToken={token}, output={token_response}")
-    stfn.send_task_success(taskToken=token, output=token_response)
-
-fl.server.start_server(config={"num_rounds": 3})
+session = requests.Session()
+
+
+def get_task_metadata():
+    """Fetch this task's metadata, retrying since the endpoint can be slow to answer right after launch."""
+    for attempt in range(1, METADATA_ATTEMPTS + 1):
+        try:
+            r = session.get(f"{metadata_uri}/task", timeout=2)
+            r.raise_for_status()
+            return r.json()
+        except (requests.RequestException, ValueError) as e:
+            if attempt == METADATA_ATTEMPTS:
+                raise
+            logger.warning(f"Could not read task metadata (attempt {attempt} of {METADATA_ATTEMPTS}): {e}")
+            time.sleep(attempt)
+
+
+def register_task():
+    """Report this task's IP back to Step Functions so the proxies can be launched."""
+    stfn = None
+    if token is not None:
+        stfn = boto3.client('stepfunctions', config=Config(tcp_keepalive=True, retries={'mode': 'adaptive', 'max_attempts': 5}))
+    try:
+        token_response = ""
+        if metadata_uri is not None:
+            task_meta = get_task_metadata()
+            logger.info(f"found task metadata: {task_meta}")
+            token_response = json.dumps({
+                "ip": task_meta['Containers'][0]['Networks'][0]['IPv4Addresses'][0],
+                "taskArn": task_meta['TaskARN']
+            })
+
+        if stfn is not None:
+            logger.info(f"send_task_success - taskToken={token}, output={token_response}")
+            stfn.send_task_success(taskToken=token, output=token_response)
+    except Exception as e:
+        logger.error(f"Failed to register task: {e}")
+        if stfn is not None:
+            try:
+                stfn.send_task_failure(taskToken=token, error='TaskRegistrationFailed', cause=str(e)[:32768])
+            except Exception as e:
+                logger.error(f"Failed to report task failure: {e}")
+        # No proxies will be launched, so exit rather than leave the server waiting for them
+        os._exit(1)
+
+
+# Registration runs alongside the gRPC listener startup instead of ahead of it
+threading.Thread(target=register_task, daemon=True).start()
+
+fl.server.start_server(config={"num_rounds": NUM_ROUNDS})
@@ -1,18 +1,31 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from collections import OrderedDict
+import io
 import json
-import time
-import tempfile
 import os
-import pickle
 import logging
+import random
+import zlib
 import sys
+import threading
+import uuid
+try:
+    import orjson
+    dumps = orjson.dumps
+except ImportError:
+    dumps = lambda obj: json.dumps(obj).encode()
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from urllib.parse import urlparse
 
 import flwr as fl
+import numpy as np
 
 import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 
 # Setup logging to stdout
 logger = logging.getLogger(__name__)
@@ -25,95 +38,212 @@ endpoint_url = os.environ['ENDPOINT']
 coordinator_url = os.environ['COORDINATOR']
 tbl = os.environ['TABLE']
 bucket = os.environ['BUCKET']
+# Only the MQTT connection is pinned to the Amazon root; the boto3 clients keep the default CA bundle
+ca_path = os.getenv('MQTT_CA_PATH', '/opt/AmazonRootCA1.pem')
+command_topic = f"commands/client/{client_id}/update"
+
+# MQTT topic prefixes the device answers on
+RESPONSE_TOPICS = ('parameters', 'set', 'fit', 'evaluate')
+
+# How long a call waits for the device to answer before resending the command, and how
+# many times it is sent before giving up. The device's handler times out after 900 s.
+RESPONSE_TIMEOUT = float(os.getenv('RESPONSE_TIMEOUT', '900'))
+RPC_ATTEMPTS = 3
+
+# Bounds of the dispatcher's poll backoff (seconds) when no MQTT notification arrives
+BACKOFF_START = 0.25
+BACKOFF_MAX = 8.0
+
+# Float32 weights travel through S3 as float16 to halve the bytes moved per round.
+# Set to None to send full precision.
+TRANSPORT_DTYPE = np.float16
+
+# set up clients, keeping connections alive between the calls of each round
+boto_config = Config(tcp_keepalive=True, max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 5})
+iot = boto3.client('iot-data', region_name=region, endpoint_url=endpoint_url, config=boto_config)
+ddbclient = boto3.client('dynamodb', region_name=region, config=boto_config)
+s3 = boto3.client('s3', region_name=region, config=boto_config)
+# Parameter blobs are small, so a single PUT/GET on the calling thread beats multipart
+small_transfer = TransferConfig(multipart_threshold=64 * 1024 * 1024, use_threads=False)
+
+def serialize_parameters(parameters):
+    """Pack a list of NumPy arrays into an in-memory .npz archive."""
+    if TRANSPORT_DTYPE is not None:
+        parameters = [p.astype(TRANSPORT_DTYPE) if p.dtype == np.float32 else p for p in parameters]
+    buf = io.BytesIO()
+    np.savez(buf, *parameters)
+    buf.seek(0)
+    return buf
+
+
+def deserialize_parameters(buf):
+    """Unpack a list of NumPy arrays written by `serialize_parameters`."""
+    with np.load(buf, allow_pickle=False) as npz:
+        parameters = [npz[f"arr_{i}"] for i in range(len(npz.files))]
+    # Upcast so training and aggregation always run in full precision
+    return [p.astype(np.float32) if p.dtype == np.float16 else p for p in parameters]
+
+
+def load_parameters(msg):
+    """Return the parameters of a response, either embedded in the row or stored in S3."""
+    if 'blob' in msg:
+        return deserialize_parameters(io.BytesIO(zlib.decompress(msg['blob'].value)))
+    return download_parameters(msg['path'])
+
+
+def download_parameters(s3_path):
+    s3_parts = s3_path.split('/')
+    n_bucket = s3_parts[2]
+    n_prefix = '/'.join(s3_parts[3:])
+    buf = io.BytesIO()
+    s3.download_fileobj(n_bucket, n_prefix, buf, Config=small_transfer)
+    buf.seek(0)
+    return deserialize_parameters(buf)
+
+
+deserializer = TypeDeserializer()
+
+
+def from_dynamodb(item):
+    """Convert a DynamoDB item from its attribute-value wire format into plain Python types."""
+    return {k: deserializer.deserialize(v) for k, v in item.items()}
+
+
+def backoff():
+    """Yield capped, jittered exponential delays between response polls."""
+    delay = BACKOFF_START
+    while True:
+        yield delay
+        delay = min(delay * 2, BACKOFF_MAX) + random.uniform(0, BACKOFF_START)
 
-# set up clients
-iot = boto3.client('iot-data', region_name=region, endpoint_url=endpoint_url)
-ddbclient = boto3.client('dynamodb', region_name=region)
-s3 = boto3.client('s3', region_name=region, verify=False)
 
 class CifarClient(fl.client.NumPyClient):
+    def __init__(self):
+        # Every in-flight call waits on a (nonce, future) pair keyed by its response type,
+        # and one background dispatcher polls the table for all of them at once.
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.wake = threading.Event()
+
+        # The device publishes each response on MQTT before the IoT rule lands it in
+        # DynamoDB, so those messages wake the dispatcher ahead of its next poll.
+        self.mqtt = AWSIoTMQTTClient(f"flower-proxy-{client_id}", useWebsocket=True)
+        self.mqtt.configureEndpoint(urlparse(endpoint_url).hostname, 443)
+        self.mqtt.configureCredentials(ca_path)
+        creds = boto3.Session(region_name=region).get_credentials().get_frozen_credentials()
+        self.mqtt.configureIAMCredentials(creds.access_key, creds.secret_key, creds.token)
+        try:
+            self.mqtt.connect()
+            for topic in RESPONSE_TOPICS:
+                self.mqtt.subscribe(f"{topic}/client/{client_id}/sent", 1, self._on_response)
+                logger.info(f"Subscribed to {topic}/client/{client_id}/sent")
+            # Responses small enough to be written to the table directly are announced here
+            self.mqtt.subscribe(f"responses/client/{client_id}/+", 1, self._on_response)
+        except Exception as e:
+            logger.error(f"Could not subscribe to responses, falling back to polling: {e}")
+
+        threading.Thread(target=self._dispatch, daemon=True).start()
+
+    def _on_response(self, client, userdata, message):
+        logger.info(f"Notified of response on {message.topic}")
+        self.wake.set()
+
+    def _dispatch(self):
+        delays = backoff()
+        while True:
+            # A new call or a notification restarts the schedule at the shortest delay
+            if self.wake.wait(next(delays)):
+                delays = backoff()
+            self.wake.clear()
+            with self.pending_lock:
+                waiting = set(self.pending)
+            if not waiting:
+                continue
+
+            for response_type in waiting:
+                try:
+                    # The key is known exactly, so read and remove the response in one call;
+                    # a newer row written in between can't be deleted unseen
+                    response = ddbclient.delete_item(
+                        TableName=tbl,
+                        Key={'client': {'S': client_id}, 'type': {'S': response_type}},
+                        ReturnValues='ALL_OLD'
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to poll for {response_type} response: {e}")
+                    continue
+                if 'Attributes' not in response:
+                    continue
+                item = from_dynamodb(response['Attributes'])
+                # A resent command can be answered twice; the extra answer carries the nonce of
+                # the call it belonged to, so it is dropped instead of resolving a later call.
+                # Responses without a nonce come from devices that predate it and are accepted.
+                with self.pending_lock:
+                    nonce, future = self.pending.get(response_type, (None, None))
+                    if future is None or item['path'].get('nonce', nonce) != nonce:
+                        logger.info(f"Dropped stale {response_type} response")
+                        continue
+                    del self.pending[response_type]
+                future.set_result(item)
+
+    def _rpc(self, method, response_type, payload):
+        # The device echoes the nonce back, which tells this call's response apart from a
+        # late answer to an earlier one
+        nonce = uuid.uuid4().hex
+        future = Future()
+        with self.pending_lock:
+            self.pending[response_type] = (nonce, future)
+        body = dumps(dict(payload, nonce=nonce))
+        for attempt in range(1, RPC_ATTEMPTS + 1):
+            iot.publish(
+                topic=command_topic,
+                qos=0,
+                payload=body
+            )
+            logger.info(f"Sent command for {method}: {body.decode()}")
+            self.wake.set()
+            try:
+                return future.result(timeout=RESPONSE_TIMEOUT)
+            except FutureTimeoutError:
+                logger.warning(f"No response for {method} after {RESPONSE_TIMEOUT} s (attempt {attempt} of {RPC_ATTEMPTS})")
+
+        with self.pending_lock:
+            self.pending.pop(response_type, None)
+        raise TimeoutError(f"Client {client_id} did not respond to {method}")
+
     def get_parameters(self):
         logger.info("Starting get_parameters")
         payload = {
             "method": "get_parameters",
             "bucket": bucket,
-            "prefix": f"parameters/get/{client_id}/params.pkl"
+            "prefix": f"parameters/get/{client_id}/params.npz"
         }
-        response = iot.publish(
-            topic=f"commands/client/{client_id}/update",
-            qos=0,
-            payload=json.dumps(payload)
-        )
-        logger.info(f"Sent command for get_parameters: {json.dumps(payload)}")
-
-        found = False
-        while found == False:
-            response = ddbclient.query( TableName=tbl, Select = 'ALL_ATTRIBUTES', 
-                            KeyConditionExpression = "client = :client AND #attmethod = :method",
-                            ExpressionAttributeNames =  { "#attmethod": "type" },
-                            ExpressionAttributeValues = { ":client":{"S":client_id}, ":method":{"S":"get"}},
-                        )
-            for i in response['Items']:
-                found = True
-                # "path":{"M":{"path":{"S":"s3://rd-flower/test/p2.pkl"},"client":{"S":"client1"}}}
-                path = i['path']['M']
-                logger.info(f"Got response for get_parameters: {json.dumps(path)}")
-                s3_path = path['path']['S']
-                s3_parts = s3_path.split('/')
-                n_bucket = s3_parts[2]
-                n_prefix = '/'.join(s3_parts[3:])
-                temp_file_d, temp_file_path = tempfile.mkstemp(dir='/tmp')
-                os.close(temp_file_d)
-                s3.download_file(n_bucket, n_prefix, temp_file_path)
-                with open(temp_file_path, 'rb') as pkl_file:
-                    p = pickle.load(pkl_file)
-                    ddbclient.delete_item(Key={'client': {'S': client_id}, 'type': {'S': 'get'}}, TableName=tbl)
-                    return p
-            logger.info("Response for get_params not found yet")
-            time.sleep(30)
+        i = self._rpc("get_parameters", "get", payload)
+
+        # "path":{"path":"s3://rd-flower/test/p2.npz","client":"client1"} or {"blob":b"...","client":"client1"}
+        path = i['path']
+        logger.info(f"Got response for get_parameters: {path.get('path', 'inline')}")
+        return load_parameters(path)
 
     def set_parameters(self, parameters):
         logger.info("Starting set_parameters")
-        prefix = f"parameters/set/{client_id}/params.pkl"
-        with tempfile.NamedTemporaryFile() as fp:
-            pickle.dump(parameters, fp)
-            logger.info(f"Dumped parameters to : {fp.name}")
-            s3.upload_file(fp.name, bucket, prefix)
+        prefix = f"parameters/set/{client_id}/params.npz"
+        s3.upload_fileobj(serialize_parameters(parameters), bucket, prefix, Config=small_transfer)
+        logger.info(f"Uploaded parameters to : {prefix}")
         payload = {
             "method": "set_parameters",
             "bucket": bucket,
             "prefix": prefix
         }
-        response = iot.publish(
-            topic=f'commands/client/{client_id}/update',
-            qos=0,
-            payload=json.dumps(payload)
-        )
-        logger.info(f"Sent command for set_parameters: {json.dumps(payload)}")
-
-        found = False
-        while found == False:
-            response = ddbclient.query( TableName=tbl, Select = 'ALL_ATTRIBUTES', 
-                            KeyConditionExpression = "client = :client AND #attmethod = :method",
-                            ExpressionAttributeNames =  { "#attmethod": "type" },
-                            ExpressionAttributeValues = { ":client":{"S":client_id}, ":method":{"S":"set"} },
-                        )
-            for i in response['Items']:
-                found = True
-                logger.info(f"Got response for set_parameters: {json.dumps(i)}")
-                ddbclient.delete_item(Key={'client': {'S': client_id}, 'type': {'S': 'set'}}, TableName=tbl)
-                break
-            logger.info("Response for set_params not found yet")
-            time.sleep(30)
+        i = self._rpc("set_parameters", "set", payload)
+        logger.info(f"Got response for set_parameters: {json.dumps(i, default=str)}")
 
     def fit(self, parameters, config):
         logger.info("Starting fit")
-        prefix = f"parameters/set/{client_id}/fit.pkl"
-        out_prefix = f"parameters/get/{client_id}/fit.pkl"
-        with tempfile.NamedTemporaryFile() as fp:
-            pickle.dump(parameters, fp)
-            logger.info(f"Dumped parameters to : {fp.name}")
-            s3.upload_file(fp.name, bucket, prefix)
+        prefix = f"parameters/set/{client_id}/fit.npz"
+        out_prefix = f"parameters/get/{client_id}/fit.npz"
+        s3.upload_fileobj(serialize_parameters(parameters), bucket, prefix, Config=small_transfer)
+        logger.info(f"Uploaded parameters to : {prefix}")
         payload = {
             "method": "fit",
             "bucket": bucket,
@@ -121,89 +251,43 @@ class CifarClient(fl.client.NumPyClient):
             "out_bucket": bucket,
             "out_prefix": out_prefix
         }
-        response = iot.publish(
-            topic=f'commands/client/{client_id}/update',
-            qos=0,
-            payload=json.dumps(payload)
-        )
-        logger.info(f"Sent command for fit: {json.dumps(payload)}")
-
-        found = False
-        while found == False:
-            response = ddbclient.query( TableName=tbl, Select = 'ALL_ATTRIBUTES', 
-                            KeyConditionExpression = "client = :client AND #attmethod = :method",
-                            ExpressionAttributeNames =  { "#attmethod": "type" },
-                            ExpressionAttributeValues = { ":client":{"S":client_id}, ":method":{"S":"fit"} },
-                        )
-            for i in response['Items']:
-                found = True
-                msg = i['path']['M']
-                logger.info(f"Got response for fit: {json.dumps(msg)}")
-                s3_path = msg['path']['S']
-                train_len = msg['train_len']['N']
-                d = msg['dict']['M']
-                s3_parts = s3_path.split('/')
-                n_bucket = s3_parts[2]
-                n_prefix = '/'.join(s3_parts[3:])
-                temp_file_d, temp_file_path = tempfile.mkstemp(dir='/tmp')
-                os.close(temp_file_d)
-                s3.download_file(n_bucket, n_prefix, temp_file_path)
-                with open(temp_file_path, 'rb') as pkl_file:
-                    p = pickle.load(pkl_file)
-                    ddbclient.delete_item(Key={'client': {'S': client_id}, 'type': {'S': 'fit'}}, TableName=tbl)
-                    return p, int(train_len), d
-            logger.info("Response for fit not found yet")
-            time.sleep(30)
+        i = self._rpc("fit", "fit", payload)
 
+        msg = i['path']
+        logger.info(f"Got response for fit: {msg.get('path', 'inline')}, train_len = {msg['train_len']}")
+        train_len = msg['train_len']
+        d = msg['dict']
+        p = load_parameters(msg)
+        return p, int(train_len), d
 
     def evaluate(self, parameters, config):
         logger.info("Starting evaluate")
-        prefix = f"parameters/set/{client_id}/eval.pkl"
-        with tempfile.NamedTemporaryFile() as fp:
-            pickle.dump(parameters, fp)
-            logger.info(f"Dumped parameters to : {fp.name}")
-            s3.upload_file(fp.name, bucket, prefix)
+        prefix = f"parameters/set/{client_id}/eval.npz"
+        s3.upload_fileobj(serialize_parameters(parameters), bucket, prefix, Config=small_transfer)
+        logger.info(f"Uploaded parameters to : {prefix}")
         payload = {
             "method": "evaluate",
             "bucket": bucket,
             "prefix": prefix
         }
-        response = iot.publish(
-            topic=f'commands/client/{client_id}/update',
-            qos=0,
-            payload=json.dumps(payload)
-        )
-        logger.info(f"Sent command for evaluate: {json.dumps(payload)}")
-
-        found = False
-        while found == False:
-            response = ddbclient.query( TableName=tbl, Select = 'ALL_ATTRIBUTES', 
-                            KeyConditionExpression = "client = :client AND #attmethod = :method",
-                            ExpressionAttributeNames =  { "#attmethod": "type" },
-                            ExpressionAttributeValues = { ":client":{"S":client_id}, ":method":{"S":"evaluate"} },
-                        )
-            for i in response['Items']:
-                found = True
-                msg = i['path']['M']
-                logger.info(f"Got response for evaluate: {json.dumps(msg)}")
-                test_len = msg['train_len']['N']
-                loss = msg['loss']['N']
-                accuracy = {
-                    'accuracy': float(msg['accuracy']['M']['accuracy']['N'])
-                }
-
-                # For constructing a CloudWatch log metric filter, we publish a clean JSON representation.
-                cw_msg = {
-                    "client": client_id,
-                    "loss": loss,
-                    "accuracy": float(msg['accuracy']['M']['accuracy']['N'])
-                }
-                print(json.dumps(cw_msg))
-
-                # msg['accuracy']['M']
-                ddbclient.delete_item(Key={'client': {'S': client_id}, 'type': {'S': 'evaluate'}}, TableName=tbl)
-                return float(loss), int(test_len), accuracy
-            logger.info("Response for evaluate not found yet")
-            time.sleep(30)
+        i = self._rpc("evaluate", "evaluate", payload)
+
+        msg = i['path']
+        logger.info(f"Got response for evaluate: {json.dumps(msg, default=str)}")
+        test_len = msg['train_len']
+        loss = float(msg['loss'])
+        accuracy = {
+            'accuracy': float(msg['accuracy']['accuracy'])
+        }
+
+        # For constructing a CloudWatch log metric filter, we publish a clean JSON representation.
+        cw_msg = {
+            "client": client_id,
+            "loss": loss,
+            "accuracy": accuracy['accuracy']
+        }
+        print(json.dumps(cw_msg))
+
+        return loss, int(test_len), accuracy
 
 fl.client.start_numpy_client(coordinator_url, client=CifarClient())
@@ -25,6 +25,8 @@ Supported commands:
     * bucket
     * prefix
 
+Every command may also carry a `nonce`, which is echoed back in its response.
+
 MQTT topics used:
 
 * flower/clients/<client id> for heartbeats
@@ -33,15 +35,16 @@ MQTT topics used:
 * set/client/<client id>/sent to send response of `set_parameters`
 * fit/client/<client id>/sent to send response of `fit`
 * evaluate/client/<client id>/sent to send response of `evaluate`
+* responses/client/<client id>/<type> to announce a response written straight to DynamoDB
 
 MQTT example events:
 
     {
         "method": "fit",
         "bucket": "rd-flower",
-        "prefix": "test/params.pkl",
+        "prefix": "test/params.npz",
         "out_bucket": "rd-flower",
-        "out_prefix": "test/new_params.pkl"
+        "out_prefix": "test/new_params.npz"
     }
 """
 
@@ -51,16 +54,22 @@ MQTT example events:
 import logging
 import platform
 import sys
-from threading import Timer
+from threading import Thread
 import json
 from collections import OrderedDict
 import asyncio
 import time
-import pickle
-import tempfile
+import io
 import uuid
 import traceback
 import os
+import atexit
+import zlib
+try:
+    import orjson
+    dumps = orjson.dumps
+except ImportError:
+    dumps = lambda obj: json.dumps(obj).encode()
 
 import greengrasssdk
 from greengrasssdk.stream_manager import (
@@ -81,12 +90,15 @@ from greengrasssdk.stream_manager import (
 )
 from greengrasssdk.stream_manager.util import Util
 import boto3
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, TensorDataset
 from torchvision.datasets import CIFAR10
 
 import flwr as fl
@@ -95,15 +107,41 @@ import flwr as fl
 # PyTorch related methods
 #
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+TRAIN_BATCH_SIZE = 128
+TEST_BATCH_SIZE = 256
+
+def _prepare_cache(split):
+    """Persist a CIFAR-10 split once as NCHW uint8 .npy files we can memory-map."""
+    x_path = f"/data/cifar_{split}.npy"
+    y_path = f"/data/cifar_{split}_labels.npy"
+    # The labels are written last, so their presence means the cache is complete
+    if not os.path.exists(y_path):
+        dataset = CIFAR10("/data", train=(split == "train"), download=True)
+        # Raw pixels take a quarter of the space of normalized floats; to_input() normalizes each batch
+        np.save(x_path, np.ascontiguousarray(dataset.data.transpose(0, 3, 1, 2)))
+        np.save(y_path, np.asarray(dataset.targets, dtype=np.int64))
+    x = np.load(x_path, mmap_mode="r")
+    y = np.load(y_path)
+    return TensorDataset(torch.from_numpy(x), torch.from_numpy(y))
+
+def to_input(images):
+    """Move a uint8 batch to the device, normalized as ToTensor() followed by Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))."""
+    images = images.to(DEVICE, non_blocking=True).to(memory_format=torch.channels_last)
+    return images.float().div_(127.5).sub_(1.0)
+
 def load_data():
     """Load CIFAR-10 (training and test set)."""
-    transform = transforms.Compose(
-    [transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
+    trainset = _prepare_cache("train")
+    testset = _prepare_cache("test")
+    # Batches come straight off the cache, so a couple of workers that only gather and
+    # collate are enough on a small core
+    loader_args = dict(
+        num_workers=min(2, os.cpu_count()),
+        pin_memory=torch.cuda.is_available()
     )
-    trainset = CIFAR10("/data", train=True, download=True, transform=transform)
-    testset = CIFAR10("/data", train=False, download=True, transform=transform)
-    trainloader = DataLoader(trainset, batch_size=32, shuffle=True)
-    testloader = DataLoader(testset, batch_size=32)
+    # Only the training pass is long enough for keeping its worker pool alive to pay off
+    trainloader = DataLoader(trainset, batch_size=TRAIN_BATCH_SIZE, shuffle=True, persistent_workers=True, **loader_args)
+    testloader = DataLoader(testset, batch_size=TEST_BATCH_SIZE, **loader_args)
     return trainloader, testloader
 
 def train(net, trainloader, epochs):
@@ -112,7 +150,8 @@ def train(net, trainloader, epochs):
     optimizer = torch.optim.SGD(net.parameters(), lr=0.001, momentum=0.9)
     for _ in range(epochs):
         for images, labels in trainloader:
-            images, labels = images.to(DEVICE), labels.to(DEVICE)
+            images = to_input(images)
+            labels = labels.to(DEVICE, non_blocking=True)
             optimizer.zero_grad()
             loss = criterion(net(images), labels)
             loss.backward()
@@ -121,17 +160,34 @@ def train(net, trainloader, epochs):
 def test(net, testloader):
     """Validate the network on the entire test set."""
     criterion = torch.nn.CrossEntropyLoss()
-    correct, total, loss = 0, 0, 0.0
+    # Accumulate on the device and read back once, instead of syncing every batch
+    loss = torch.zeros((), device=DEVICE)
+    correct = torch.zeros((), device=DEVICE, dtype=torch.long)
+    total = 0
     with torch.no_grad():
         for data in testloader:
-            images, labels = data[0].to(DEVICE), data[1].to(DEVICE)
+            images = to_input(data[0])
+            labels = data[1].to(DEVICE, non_blocking=True)
             outputs = net(images)
-            loss += criterion(outputs, labels).item()
-            _, predicted = torch.max(outputs.data, 1)
+            loss += criterion(outputs, labels)
             total += labels.size(0)
-            correct += (predicted == labels).sum().item()
-    accuracy = correct / total
-    return loss, accuracy
+            correct += (outputs.argmax(1) == labels).sum()
+    accuracy = correct.item() / total
+    # Average over batches so the reported loss doesn't depend on the batch size
+    return loss.item() / len(testloader), accuracy
+
+def warm_up(net):
+    """Run one training step and one evaluation batch at the real batch sizes, leaving the weights untouched."""
+    criterion = torch.nn.CrossEntropyLoss()
+    images = torch.zeros(TRAIN_BATCH_SIZE, 3, 32, 32, device=DEVICE).to(memory_format=torch.channels_last)
+    labels = torch.zeros(TRAIN_BATCH_SIZE, dtype=torch.long, device=DEVICE)
+    net.train()
+    criterion(net(images), labels).backward()
+    net.zero_grad(set_to_none=True)
+    net.eval()
+    with torch.no_grad():
+        net(torch.zeros(TEST_BATCH_SIZE, 3, 32, 32, device=DEVICE).to(memory_format=torch.channels_last))
+    net.train()
 
 class Net(nn.Module):
     def __init__(self) -> None:
@@ -146,7 +202,8 @@ class Net(nn.Module):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.pool(F.relu(self.conv1(x)))
         x = self.pool(F.relu(self.conv2(x)))
-        x = x.view(-1, 16 * 5 * 5)
+        # flatten rather than view: activations are channels-last, not contiguous NCHW
+        x = torch.flatten(x, 1)
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
         x = self.fc3(x)
@@ -161,7 +218,17 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 # Load model and data
-net = Net().to(DEVICE)
+# Channels-last lets oneDNN pick its optimized CPU convolution kernels
+net = Net().to(DEVICE, memory_format=torch.channels_last)
+# Compile once so the train/test loops skip per-op Python dispatch. Compilation happens on
+# the first calls, so warm up here rather than in the first fit round, and keep the eager
+# model if any of it fails.
+try:
+    compiled = torch.compile(net) if hasattr(torch, 'compile') else torch.jit.script(net)
+    warm_up(compiled)
+    net = compiled
+except Exception as e:
+    logger.warning(f"Could not compile the model, running it eagerly: {e}")
 trainloader, testloader = load_data()
 logger.info("Downloaded dataset")
 
@@ -169,53 +236,157 @@ logger.info("Downloaded dataset")
 client = greengrasssdk.client("iot-data")
 logger.info("Created GG client")
 
+# Creating the AWS clients once so their connections are reused across invocations.
+# Follow the core's region so a relocated device doesn't silently go cross-region.
+region = os.environ.get('AWS_REGION', 'us-west-2')
+# The core pins botocore 1.23 (cfn/flower-demo.yaml), which predates Config(tcp_keepalive=...)
+boto_config = Config(max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 5})
+s3 = boto3.client('s3', region_name=region, config=boto_config)
+ddbclient = boto3.client('dynamodb', region_name=region, config=boto_config)
+serializer = TypeSerializer()
+
+# Response table, set in the function's environment by gg_setup.py
+tbl = os.getenv('TABLE')
+
 # Retrieving platform information to send from Greengrass Core
 my_platform = platform.platform()
 
 #client_id = 'client1'
 client_id = str(uuid.uuid4())
 
+# Topics only depend on the client id, so they are built once
+heartbeat_topic = f"flower/clients/{client_id}"
+parameters_topic = f"parameters/client/{client_id}/sent"
+set_topic = f"set/client/{client_id}/sent"
+fit_topic = f"fit/client/{client_id}/sent"
+evaluate_topic = f"evaluate/client/{client_id}/sent"
+responses_topic = f"responses/client/{client_id}"
+
 #
 # Heartbeat
 #
+# Only the timestamp changes between beats, so the JSON is rendered once up front
+heartbeat_template = '{"client": %s, "time": %%d}' % json.dumps(client_id)
+
 def greengrass_hello_world_run():
-    try:
-        logger.info("Publishing message")
-        payload = {
-            "client": client_id,
-            "time": int(time.time())
-        }
-        client.publish(topic="flower/clients/{0}".format(client_id), payload=json.dumps(payload))
-    except Exception as e:
-        logger.error("Failed to publish message: " + repr(e))
-        traceback.print_exc()
+    while True:
+        try:
+            logger.info("Publishing message")
+            client.publish(topic=heartbeat_topic, payload=heartbeat_template % int(time.time()))
+        except Exception as e:
+            logger.error("Failed to publish message: " + repr(e))
+            traceback.print_exc()
 
-    # Asynchronously schedule this function to be run again in 60 seconds
-    Timer(60, greengrass_hello_world_run).start()
+        time.sleep(60)
 
-# Start executing the function above
-greengrass_hello_world_run()
+# Start executing the function above on a single background thread
+Thread(target=greengrass_hello_world_run, daemon=True).start()
 
 #
 # Flower methods
 #
+# The model's layout never changes, so its state dict keys are looked up once
+param_keys = list(net.state_dict().keys())
+
 def get_parameters():
-    return [val.cpu().numpy() for _, val in net.state_dict().items()]
+    return [val.detach().cpu().numpy() for val in net.state_dict().values()]
 
 def set_parameters(parameters):
-    params_dict = zip(net.state_dict().keys(), parameters)
-    state_dict = OrderedDict({k: torch.Tensor(v) for k, v in params_dict})
+    # from_numpy wraps the arrays without a copy; load_state_dict copies them into the model once
+    state_dict = OrderedDict(zip(param_keys, (torch.from_numpy(np.ascontiguousarray(v)) for v in parameters)))
     net.load_state_dict(state_dict, strict=True)
 
 def fit(parameters):
     set_parameters(parameters)
     train(net, trainloader, epochs=1)
-    return get_parameters(), len(trainloader), {}
+    return get_parameters(), len(trainloader.dataset), {}
 
 def evaluate(parameters):
     set_parameters(parameters)
-    loss, accuracy = test(net, testloader)
-    return float(loss), len(testloader), {"accuracy":float(accuracy)}
+    net.eval()
+    try:
+        loss, accuracy = test(net, testloader)
+    finally:
+        net.train()
+    return float(loss), len(testloader.dataset), {"accuracy":float(accuracy)}
+
+#
+# Parameter transport
+#
+
+# Float32 weights travel through S3 as float16 to halve the bytes moved per round.
+# Set to None to send full precision.
+TRANSPORT_DTYPE = np.float16
+
+# Payloads smaller than this are PUT straight to S3 instead of exported through Stream Manager
+DIRECT_UPLOAD_LIMIT = 5 * 1024 * 1024
+upload_paths = {m: f"/data/{client_id}_{m}.npz" for m in ('get_parameters', 'fit')}
+
+# Compressed payloads below this fit in a DynamoDB item (400 KB limit) next to the response
+INLINE_LIMIT = 380 * 1024
+
+def serialize_parameters(parameters):
+    """Pack a list of NumPy arrays into an in-memory .npz archive."""
+    if TRANSPORT_DTYPE is not None:
+        parameters = [p.astype(TRANSPORT_DTYPE) if p.dtype == np.float32 else p for p in parameters]
+    buf = io.BytesIO()
+    np.savez(buf, *parameters)
+    buf.seek(0)
+    return buf
+
+def deserialize_parameters(buf):
+    """Unpack a list of NumPy arrays written by `serialize_parameters`."""
+    with np.load(buf, allow_pickle=False) as npz:
+        parameters = [npz[f"arr_{i}"] for i in range(len(npz.files))]
+    # Upcast so training and aggregation always run in full precision
+    return [p.astype(np.float32) if p.dtype == np.float16 else p for p in parameters]
+
+def download_parameters(bucket, prefix):
+    body = s3.get_object(Bucket=bucket, Key=prefix)['Body'].read()
+    return deserialize_parameters(io.BytesIO(body))
+
+def upload_parameters(method, parameters, bucket, prefix):
+    data = serialize_parameters(parameters).getvalue()
+    if len(data) < DIRECT_UPLOAD_LIMIT:
+        s3.put_object(Bucket=bucket, Key=prefix, Body=data)
+        logger.info(f"Uploaded parameters to : s3://{bucket}/{prefix}")
+        return
+
+    # Large payloads go through Stream Manager, which exports from disk. Each method
+    # reuses one file, truncated in place, since the export finishes before we return.
+    with open(upload_paths[method], 'wb') as fp:
+        fp.write(data)
+    logger.info(f"Dumped parameters to : {fp.name}")
+    upload_to_s3(bucket, prefix, fp.name.replace('data', 'tmp'))
+
+def respond_inline(response_type, payload, parameters):
+    """Write a response with its parameters embedded directly into the response table.
+
+    Returns False when the table is unknown, the parameters are too large or the
+    write fails, in which case the caller uploads to S3 and responds through the
+    IoT rule instead.
+    """
+    if tbl is None:
+        return False
+    blob = zlib.compress(serialize_parameters(parameters).getvalue())
+    if len(blob) >= INLINE_LIMIT:
+        return False
+
+    item = {
+        "client": client_id,
+        "type": response_type,
+        "path": dict(payload, blob=blob)
+    }
+    try:
+        ddbclient.put_item(TableName=tbl, Item={k: serializer.serialize(v) for k, v in item.items()})
+    except ClientError as e:
+        # e.g. a stack without the dynamodb:PutItem grant, or throttling; S3 still works
+        logger.error(f"Could not respond inline to {response_type}, falling back to S3: {e}")
+        return False
+    # This topic has no IoT rule behind it, so it only wakes the proxy
+    client.publish(topic=f"{responses_topic}/{response_type}", payload=dumps({"client": client_id}))
+    logger.info(f"Responded inline to {response_type}, {len(blob)} bytes")
+    return True
 
 # 
 # IoT helper methods
@@ -228,71 +399,93 @@ def get_input_topic(context):
         traceback.print_exc()
     return topic
     
-def upload_to_s3(bucket, prefix, fpath):
-    try:
-        stream_name = f"S3UploadStream{int(time.time())}"
-        status_stream_name = f"{stream_name}Status"
-        bucket_name = bucket
-        key_name = prefix
-        file_url = f"file://{fpath}"
-        s_client = StreamManagerClient()
-        logger.info(f"Uploading to S3 from: {file_url}")
-
-        # Try deleting the status stream (if it exists) so that we have a fresh start
+# One export stream (and its status stream) serves every upload this process makes
+UPLOAD_STREAM = "FLUploadStream"
+UPLOAD_STATUS_STREAM = f"{UPLOAD_STREAM}Status"
+# Connected on the first large upload. Stream Manager is a separate pinned Lambda that may
+# still be starting when this one loads, and most payloads never need it.
+stream_client = None
+next_status_sequence = 0
+
+def create_upload_streams(stream_client):
+    # Try deleting the streams (if they exist) so that we have a fresh start
+    for stream_name in (UPLOAD_STATUS_STREAM, UPLOAD_STREAM):
         try:
-            s_client.delete_message_stream(stream_name=status_stream_name)
+            stream_client.delete_message_stream(stream_name=stream_name)
         except ResourceNotFoundException:
             pass
 
-        # Try deleting the stream (if it exists) so that we have a fresh start
-        try:
-            s_client.delete_message_stream(stream_name=stream_name)
-        except ResourceNotFoundException:
-            pass
+    exports = ExportDefinition(
+        s3_task_executor=[
+            S3ExportTaskExecutorConfig(
+                identifier="S3TaskExecutor" + UPLOAD_STREAM,  # Required
+                # Optional. Add an export status stream to add statuses for all S3 upload tasks.
+                status_config=StatusConfig(
+                    status_level=StatusLevel.INFO,  # Default is INFO level statuses.
+                    # Status Stream should be created before specifying in S3 Export Config.
+                    status_stream_name=UPLOAD_STATUS_STREAM,
+                ),
+            )
+        ]
+    )
 
-        exports = ExportDefinition(
-            s3_task_executor=[
-                S3ExportTaskExecutorConfig(
-                    identifier="S3TaskExecutor" + stream_name,  # Required
-                    # Optional. Add an export status stream to add statuses for all S3 upload tasks.
-                    status_config=StatusConfig(
-                        status_level=StatusLevel.INFO,  # Default is INFO level statuses.
-                        # Status Stream should be created before specifying in S3 Export Config.
-                        status_stream_name=status_stream_name,
-                    ),
-                )
-            ]
-        )
+    # Create the Status Stream.
+    stream_client.create_message_stream(
+        MessageStreamDefinition(name=UPLOAD_STATUS_STREAM, strategy_on_full=StrategyOnFull.OverwriteOldestData)
+    )
 
-        # Create the Status Stream.
-        s_client.create_message_stream(
-            MessageStreamDefinition(name=status_stream_name, strategy_on_full=StrategyOnFull.OverwriteOldestData)
+    # Create the message stream with the S3 Export definition.
+    stream_client.create_message_stream(
+        MessageStreamDefinition(
+            name=UPLOAD_STREAM, strategy_on_full=StrategyOnFull.OverwriteOldestData, export_definition=exports
         )
+    )
+    logger.info(f"Created upload stream {UPLOAD_STREAM}")
 
-        # Create the message stream with the S3 Export definition.
-        s_client.create_message_stream(
-            MessageStreamDefinition(
-                name=stream_name, strategy_on_full=StrategyOnFull.OverwriteOldestData, export_definition=exports
-            )
-        )
+def connect_upload_streams():
+    new_client = StreamManagerClient()
+    try:
+        create_upload_streams(new_client)
+    except Exception:
+        new_client.close()
+        raise
+    atexit.register(new_client.close)
+    return new_client
+
+def upload_to_s3(bucket, prefix, fpath):
+    global stream_client, next_status_sequence
+    try:
+        if stream_client is None:
+            stream_client = connect_upload_streams()
+        file_url = f"file://{fpath}"
+        logger.info(f"Uploading to S3 from: {file_url}")
 
         # Append a S3 Task definition and print the sequence number
-        s3_export_task_definition = S3ExportTaskDefinition(input_url=file_url, bucket=bucket_name, key=key_name)
+        s3_export_task_definition = S3ExportTaskDefinition(input_url=file_url, bucket=bucket, key=prefix)
         logger.info(
             "Successfully appended S3 Task Definition to stream with sequence number %d",
-            s_client.append_message(stream_name, Util.validate_and_serialize_to_json_bytes(s3_export_task_definition)),
+            stream_client.append_message(UPLOAD_STREAM, Util.validate_and_serialize_to_json_bytes(s3_export_task_definition)),
         )
 
-        # Read the statuses from the export status stream
+        # Tail the status stream from where the previous upload left off
         is_file_uploaded_to_s3 = False
         while not is_file_uploaded_to_s3:
             try:
-                messages_list = s_client.read_messages(
-                    status_stream_name, ReadMessagesOptions(min_message_count=1, read_timeout_millis=10000)
+                messages_list = stream_client.read_messages(
+                    UPLOAD_STATUS_STREAM,
+                    ReadMessagesOptions(
+                        desired_start_sequence_number=next_status_sequence,
+                        min_message_count=1,
+                        read_timeout_millis=10000
+                    )
                 )
                 for message in messages_list:
+                    next_status_sequence = message.sequence_number + 1
                     # Deserialize the status message first.
                     status_message = Util.deserialize_json_bytes_to_obj(message.payload, StatusMessage)
+                    task = status_message.status_context.s3_export_task_definition
+                    if task.input_url != file_url or task.key != prefix:
+                        continue
 
                     # Check the status of the status message. If the status is "Success",
                     # the file was successfully uploaded to S3.
@@ -308,20 +501,17 @@ def upload_to_s3(bucket, prefix, fpath):
                             "Unable to upload file at path " + file_url + " to S3. Message: " + status_message.message
                         )
                         is_file_uploaded_to_s3 = True
-                time.sleep(5)
             except NotEnoughMessagesException:
                 logger.info("NotEnoughMessagesException")
             except StreamManagerException:
                 logger.exception("Exception while running")
+                time.sleep(1)
     except asyncio.TimeoutError:
         logger.exception("Timed out while executing")
         traceback.print_exc()
     except Exception:
         logger.exception("Exception while running")
         traceback.print_exc()
-    finally:
-        if s_client:
-            s_client.close()
 
 """
 Invoked for new MQTT messages.
@@ -346,32 +536,27 @@ def function_handler(event, context):
             prefix = event['prefix']
             logger.info(f"Handling get_parameters: bucket = {bucket}, prefix = {prefix}")
             p = get_parameters()
-            with tempfile.NamedTemporaryFile(dir = '/data', delete=False) as fp:
-                pickle.dump(p, fp)
-                logger.info(f"Dumped parameters to : {fp.name}")
-                upload_to_s3(bucket, prefix, fp.name.replace('data', 'tmp'))
-                payload = {
-                    "client": client_id,
-                    "path": f"s3://{bucket}/{prefix}"
-                }
-                client.publish(topic="parameters/client/{0}/sent".format(client_id), payload=json.dumps(payload))
+            payload = {
+                "client": client_id,
+                "nonce": event.get('nonce')
+            }
+            if not respond_inline('get', payload, p):
+                upload_parameters(method, p, bucket, prefix)
+                payload["path"] = f"s3://{bucket}/{prefix}"
+                client.publish(topic=parameters_topic, payload=dumps(payload))
         elif method == 'set_parameters':
             logger.info("Handling set_parameters")
             bucket = event['bucket']
             prefix = event['prefix']
             logger.info(f"Handling set_parameters: bucket = {bucket}, prefix = {prefix}")
-            s3 = boto3.client('s3', region_name='us-west-2')
-            temp_file_d, temp_file_path = tempfile.mkstemp(dir='/data')
-            os.close(temp_file_d)
-            s3.download_file(bucket, prefix, temp_file_path)
-            with open(temp_file_path, 'rb') as pkl_file:
-                p = pickle.load(pkl_file)
-                set_parameters(p)
+            p = download_parameters(bucket, prefix)
+            set_parameters(p)
             logger.info(f"Updated parameters, type = {type(p)}, shape = {len(p)}")
             payload = {
-                "client": client_id
+                "client": client_id,
+                "nonce": event.get('nonce')
             }
-            client.publish(topic="set/client/{0}/sent".format(client_id), payload=json.dumps(payload))
+            client.publish(topic=set_topic, payload=dumps(payload))
 
         elif method == 'fit':
             logger.info("Handling fit")
@@ -380,46 +565,36 @@ def function_handler(event, context):
             out_bucket = event['out_bucket']
             out_prefix = event['out_prefix']
             logger.info(f"Handling fit: bucket = {bucket}, prefix = {prefix}")
-            s3 = boto3.client('s3', region_name='us-west-2')
-            temp_file_d, temp_file_path = tempfile.mkstemp(dir='/data')
-            os.close(temp_file_d)
-            s3.download_file(bucket, prefix, temp_file_path)
-            with open(temp_file_path, 'rb') as pkl_file:
-                p = pickle.load(pkl_file)
-                new_p, l, j = fit(p)
-            logger.info(f"Ran fit: len trainloader = {l}")
-            with tempfile.NamedTemporaryFile(dir = '/data', delete=False) as fp:
-                pickle.dump(new_p, fp)
-                logger.info(f"Dumped fit parameters to : {fp.name}")
-                upload_to_s3(out_bucket, out_prefix, fp.name.replace('data', 'tmp'))
-                payload = {
-                    "client": client_id,
-                    "path": f"s3://{out_bucket}/{out_prefix}",
-                    "train_len": l,
-                    "dict": j
-                }
-                client.publish(topic="fit/client/{0}/sent".format(client_id), payload=json.dumps(payload))
-                logger.info("Done with fit")
+            p = download_parameters(bucket, prefix)
+            new_p, l, j = fit(p)
+            logger.info(f"Ran fit: {l} training examples")
+            payload = {
+                "client": client_id,
+                "nonce": event.get('nonce'),
+                "train_len": l,
+                "dict": j
+            }
+            if not respond_inline('fit', payload, new_p):
+                upload_parameters(method, new_p, out_bucket, out_prefix)
+                payload["path"] = f"s3://{out_bucket}/{out_prefix}"
+                client.publish(topic=fit_topic, payload=dumps(payload))
+            logger.info("Done with fit")
         elif method == 'evaluate':
             logger.info("Handling evaluate")
             bucket = event['bucket']
             prefix = event['prefix']
             logger.info(f"Handling evaluate: bucket = {bucket}, prefix = {prefix}")
-            s3 = boto3.client('s3', region_name='us-west-2')
-            temp_file_d, temp_file_path = tempfile.mkstemp(dir='/data')
-            os.close(temp_file_d)
-            s3.download_file(bucket, prefix, temp_file_path)
-            with open(temp_file_path, 'rb') as pkl_file:
-                p = pickle.load(pkl_file)
-                loss, l, accuracy = evaluate(p)
-            logger.info(f"Ran evaluate: len trainloader = {l}")
+            p = download_parameters(bucket, prefix)
+            loss, l, accuracy = evaluate(p)
+            logger.info(f"Ran evaluate: {l} test examples")
             payload = {
                 "client": client_id,
+                "nonce": event.get('nonce'),
                 "loss": loss,
                 "train_len": l,
                 "accuracy": accuracy
             }
-            client.publish(topic="evaluate/client/{0}/sent".format(client_id), payload=json.dumps(payload))
+            client.publish(topic=evaluate_topic, payload=dumps(payload))
             logger.info("Done with evaluate")
         else:
             logger.warn(f"Invalid method: {method}")
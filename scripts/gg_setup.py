@@ -1,186 +1,285 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import logging
+import logging.handlers
 import json
 import argparse
-
-
+import atexit
+import queue
+import os
+import uuid
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+import botocore.session
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Keep connections open across the long chains of setup/cleanup calls and let
+# botocore back off on throttling
+boto_config = Config(max_pool_connections=50, tcp_keepalive=True, retries={'mode': 'adaptive', 'max_attempts': 10})
+# One session for the whole run, so credentials are resolved once, and one
+# client per service shared by every helper below. Only low-level clients are used,
+# so the session comes straight from botocore rather than boto3.
+session = botocore.session.get_session()
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name):
+    # Sessions aren't thread safe, so clients are only ever built under the lock
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = session.create_client(name, config=boto_config)
+        return _clients[name]
+
+
+def preload_clients():
+    for name in ('cloudformation', 'greengrass', 'iot'):
+        get_client(name)
+
+
+# Loading the service models takes a while, so start on it in the background while
+# the arguments and config are read; get_client() waits on the lock until it is done.
+if os.environ.get('GG_SETUP_PRELOAD', '1') == '1':
+    threading.Thread(target=preload_clients, daemon=True).start()
+
+
+def paginate(client, method, key, match=None, limit=None, **kwargs):
+    """Collect `key` from every page of a list call, rather than just the first one.
+
+    Items are filtered with `match` as each page arrives, and paging stops once
+    `limit` matches have been found.
+    """
+    items = []
+    for page in client.get_paginator(method).paginate(**kwargs):
+        items.extend(item for item in page.get(key, []) if match is None or match(item))
+        if limit is not None and len(items) >= limit:
+            return items[:limit]
+    return items
+
+
+def is_ours(cfg, prefix, definition):
+    # Our definitions are named exactly "<prefix>-<DEF_UNIQUE_KEY>", where the prefix is
+    # rd, fd, sub or logdef. Older runs named the subscription definition after its last
+    # subscription, "sub-<DEF_UNIQUE_KEY>-heartbeat", so that name is still recognized.
+    key = cfg['DEF_UNIQUE_KEY']
+    name = definition.get('Name')
+    return name == f"{prefix}-{key}" or (prefix == 'sub' and name == f"sub-{key}-heartbeat")
+
+
+# Scopes the idempotency tokens to this run. A token that outlived the run could hand back a
+# definition deleted by --clean, or be refused once the definition's payload changes.
+RUN_ID = uuid.uuid4().hex
+
+
+def client_token(kind):
+    """Idempotency token for creating one kind of definition, so retries within this run don't create it twice."""
+    return f"{RUN_ID}-{kind}"
+
+
+def log_error(e):
+    """Log a failed call, but let throttling that outlasted the client's retries propagate."""
+    if e.response['Error']['Code'] in ('ThrottlingException', 'TooManyRequestsException'):
+        raise e
+    logger.error(e)
+
+
+# describe_stacks is heavily rate limited, so the stack outputs are only read once per run
+@lru_cache(maxsize=1)
 def read_cfg():
-    client = boto3.client('cloudformation')
-
-    with open('gg_setup.json', 'r') as F:
-        cfg = json.load(F)
+    with open('gg_setup.json', 'rb') as F:
+        cfg = loads(F.read())
 
     try:
 
-        response = client.describe_stacks(
+        response = get_client('cloudformation').describe_stacks(
             StackName=cfg['STACK_NAME'],
         )
         if 'Stacks' in response and response['Stacks'][0]['StackName'] == cfg['STACK_NAME']:
-            for output in response['Stacks'][0]['Outputs']:
-                cfg[output['OutputKey']] = output['OutputValue']
-        logger.info(cfg)
+            cfg.update({o['OutputKey']: o['OutputValue'] for o in response['Stacks'][0]['Outputs']})
         return cfg
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
+def save_cfg_entry(key, value):
+    """Persist one entry in gg_setup.json, or drop it when value is None."""
+    with open('gg_setup.json', 'rb') as F:
+        saved = loads(F.read())
+    if value is None:
+        saved.pop(key, None)
+    else:
+        saved[key] = value
+    with open('gg_setup.json', 'w') as F:
+        json.dump(saved, F, indent=4)
+
+
 def register_role(cfg, gg_group):
-    client = boto3.client('greengrass')
+    client = get_client('greengrass')
     exists = True
     try:
         response = client.get_associated_role(
             GroupId=gg_group['Id']
         )
         if response['RoleArn'] == cfg['GgRoleArn']:
-            logger.info(f"Role {cfg['GgRoleArn']} already registered")
+            logger.info("Role %s already registered", cfg['GgRoleArn'])
         else:
             exists = False
-    except Exception as e:
-        logger.info(f"Role {cfg['GgRoleArn']} already registered")
+    except ClientError as e:
+        logger.info("No role registered to group %s", gg_group['Id'])
         exists = False
 
     if exists == False:
-        logger.info(f"Registering role {cfg['GgRoleArn']} to group {gg_group['Id']}")
+        logger.info("Registering role %s to group %s", cfg['GgRoleArn'], gg_group['Id'])
         try:
             response = client.associate_role_to_group(
                 GroupId=gg_group['Id'],
                 RoleArn=cfg['GgRoleArn']
             )
-        except Exception as e:
-            logger.error(e)
+        except ClientError as e:
+            log_error(e)
 
 
-def get_latest_group_version(cfg, gg_group):
-    client = boto3.client('greengrass')
+# Group lookups don't change within a run, so each is only made once per group. lru_cache
+# doesn't keep calls that raised, so the API errors are only caught in the wrappers below
+# and a transient failure is retried on the next lookup instead of being cached.
+@lru_cache(maxsize=None)
+def fetch_group(group_id):
+    return get_client('greengrass').get_group(GroupId=group_id)
+
+
+@lru_cache(maxsize=None)
+def fetch_group_version(group_id, version_arn):
+    return get_client('greengrass').get_group_version(GroupId=group_id, GroupVersionId=version_arn)
+
+
+def get_latest_group_version(group_id):
     try:
-        response = client.get_group(
-            GroupId=gg_group['Id'],
-        )
-        latest_version_arn = response['LatestVersionArn']
-        latest_version_id = response['LatestVersion']
-        logger.info(f"Latest group version: {latest_version_id} - {latest_version_arn}")
-        return latest_version_arn, latest_version_id
-    except Exception as e:
-        logger.error(e)
-        logger.info(f"Group {gg_group['Id']} has no version yet")
+        response = fetch_group(group_id)
+    except ClientError as e:
+        log_error(e)
         return None, None
+    # A group that has never been given a version has no LatestVersion fields
+    latest_version_arn = response.get('LatestVersionArn')
+    latest_version_id = response.get('LatestVersion')
+    if latest_version_id is None:
+        logger.info("Group %s has no version yet", group_id)
+    else:
+        logger.info("Latest group version: %s - %s", latest_version_id, latest_version_arn)
+    return latest_version_arn, latest_version_id
 
 
-def get_group_definition(cfg, gg_group, version_arn):
-    client = boto3.client('greengrass')
+def get_group_definition(group_id, version_arn):
+    # Without a version there is nothing to look up, and botocore would reject the call
+    # with a ParamValidationError, which isn't a ClientError
+    if version_arn is None:
+        return {}
     try:
-        response = client.get_group_version(
-            GroupId=gg_group['Id'],
-            GroupVersionId=version_arn
-        )
-        logger.info(f"Got group version info for group {gg_group['Id']}")
+        response = fetch_group_version(group_id, version_arn)
+        logger.info("Got group version info for group %s", group_id)
         return response['Definition']
-    except Exception as e:
-        logger.error(e)
-        return []
+    except ClientError as e:
+        log_error(e)
+        return {}
 
 
-def get_resource_definitions(cfg):
-    client = boto3.client('greengrass')
+def get_definitions(cfg, method, kind, prefix, limit=None):
+    """List our definitions of one kind, named with `prefix`, through the given list_*_definitions call."""
+    client = get_client('greengrass')
     try:
-        response = client.list_resource_definitions()
-        logger.info(f"Got {len(response['Definitions'])} resource definitions")
-        return response['Definitions']
-    except Exception as e:
-        logger.error(e)
+        definitions = paginate(client, method, 'Definitions', match=partial(is_ours, cfg, prefix), limit=limit)
+        logger.info("Got %s matching %s definitions", len(definitions), kind)
+        return definitions
+    except ClientError as e:
+        log_error(e)
         return []
 
 
-def get_fn_definitions(cfg):
-    client = boto3.client('greengrass')
-    try:
-        response = client.list_function_definitions()
-        logger.info(f"Got {len(response['Definitions'])} fn definitions")
-        return response['Definitions']
-    except Exception as e:
-        logger.error(e)
-        return []
+def get_resource_definitions(cfg, limit=None):
+    return get_definitions(cfg, 'list_resource_definitions', 'resource', 'rd', limit)
 
 
-def get_sub_definitions(cfg):
-    client = boto3.client('greengrass')
-    try:
-        response = client.list_subscription_definitions()
-        logger.info(f"Got {len(response['Definitions'])} subscription definitions")
-        return response['Definitions']
-    except Exception as e:
-        logger.error(e)
-        return []
+def get_fn_definitions(cfg, limit=None):
+    return get_definitions(cfg, 'list_function_definitions', 'fn', 'fd', limit)
 
 
-def get_log_definitions(cfg):
-    client = boto3.client('greengrass')
-    try:
-        response = client.list_logger_definitions()
-        logger.info(f"Got {len(response['Definitions'])} logger definitions")
-        return response['Definitions']
-    except Exception as e:
-        logger.error(e)
-        return []
+def get_sub_definitions(cfg, limit=None):
+    return get_definitions(cfg, 'list_subscription_definitions', 'subscription', 'sub', limit)
+
+
+def get_log_definitions(cfg, limit=None):
+    return get_definitions(cfg, 'list_logger_definitions', 'logger', 'logdef', limit)
+
+
+# Loggers for our definition; each Id gets DEF_UNIQUE_KEY filled in when it is created
+LOGGERS = [
+    {
+        'Component': 'GreengrassSystem',
+        'Id': 'GreengrassSystemFS-{key}',
+        'Type': 'FileSystem',
+        'Level': 'INFO',
+        'Space': 25600
+    },
+    {
+        'Component': 'Lambda',
+        'Id': 'LambdaFS-{key}',
+        'Type': 'FileSystem',
+        'Level': 'INFO',
+        'Space': 25600
+    },
+    {
+        'Component': 'GreengrassSystem',
+        'Id': 'GreengrassSystemCW-{key}',
+        'Type': 'AWSCloudWatch',
+        'Level': 'INFO'
+    },
+    {
+        'Component': 'Lambda',
+        'Id': 'LambdaCW-{key}',
+        'Type': 'AWSCloudWatch',
+        'Level': 'INFO'
+    }
+]
 
 
 def create_log_def(cfg):
-    client = boto3.client('greengrass')
-    logger.info(f"Creating logger definition")
+    client = get_client('greengrass')
+    key = cfg['DEF_UNIQUE_KEY']
+    logger.info("Creating logger definition")
     try:
         response = client.create_logger_definition(
-            Name=f"logdef-{cfg['DEF_UNIQUE_KEY']}",
+            AmznClientToken=client_token('logdef'),
+            Name=f"logdef-{key}",
             InitialVersion={
-                'Loggers': [
-                    {
-                        'Component': 'GreengrassSystem',
-                        'Id': f"GreengrassSystemFS-{cfg['DEF_UNIQUE_KEY']}",
-                        'Type': 'FileSystem',
-                        'Level': 'INFO',
-                        'Space': 25600
-                    },
-                    {
-                        'Component': 'Lambda',
-                        'Id': f"LambdaFS-{cfg['DEF_UNIQUE_KEY']}",
-                        'Type': 'FileSystem',
-                        'Level': 'INFO',
-                        'Space': 25600
-                    },
-                    {
-                        'Component': 'GreengrassSystem',
-                        'Id': f"GreengrassSystemCW-{cfg['DEF_UNIQUE_KEY']}",
-                        'Type': 'AWSCloudWatch',
-                        'Level': 'INFO'
-                    },
-                    {
-                        'Component': 'Lambda',
-                        'Id': f"LambdaCW-{cfg['DEF_UNIQUE_KEY']}",
-                        'Type': 'AWSCloudWatch',
-                        'Level': 'INFO'
-                    }
-                ]
+                'Loggers': [dict(l, Id=l['Id'].format(key=key)) for l in LOGGERS]
             }
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return []
 
 
 def create_fs_resource(cfg):
-    client = boto3.client('greengrass')
+    client = get_client('greengrass')
+    key = cfg['DEF_UNIQUE_KEY']
     try:
-        logger.info(f"Creating file system resource")
+        logger.info("Creating file system resource")
         response = client.create_resource_definition(
+            AmznClientToken=client_token('rd'),
             InitialVersion={
                 'Resources': [
                     {
-                        'Id': f"tmpdir-{cfg['DEF_UNIQUE_KEY']}",
-                        'Name': f"tmpdir-{cfg['DEF_UNIQUE_KEY']}",
+                        'Id': f"tmpdir-{key}",
+                        'Name': f"tmpdir-{key}",
                         'ResourceDataContainer': {
                             'LocalVolumeResourceData': {
                                 'DestinationPath': '/data',
@@ -190,18 +289,20 @@ def create_fs_resource(cfg):
                     },
                 ]
             },
-            Name=f"rd-{cfg['DEF_UNIQUE_KEY']}",
+            Name=f"rd-{key}",
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 def create_fn(cfg):
-    client = boto3.client('greengrass')
+    client = get_client('greengrass')
+    key = cfg['DEF_UNIQUE_KEY']
     try:
-        logger.info(f"Creating lambda fn")
+        logger.info("Creating lambda fn")
         response = client.create_function_definition(
+            AmznClientToken=client_token('fd'),
             InitialVersion={
                 'DefaultConfig': {
                     'Execution': {
@@ -214,6 +315,9 @@ def create_fn(cfg):
                         'FunctionConfiguration': {
                             'EncodingType': 'json',
                             'Environment': {
+                                'Variables': {
+                                    'TABLE': cfg['TableName']
+                                },
                                 'AccessSysfs': False,
                                 'Execution': {
                                     'IsolationMode': 'GreengrassContainer'
@@ -221,7 +325,7 @@ def create_fn(cfg):
                                 'ResourceAccessPolicies': [
                                     {
                                         'Permission': 'rw',
-                                        'ResourceId': f"tmpdir-{cfg['DEF_UNIQUE_KEY']}",
+                                        'ResourceId': f"tmpdir-{key}",
                                     },
                                 ],
                             },
@@ -229,7 +333,7 @@ def create_fn(cfg):
                             'Pinned': True,
                             'Timeout': 900
                         },
-                        'Id': f"fn-{cfg['DEF_UNIQUE_KEY']}",
+                        'Id': f"fn-{key}",
                     },
                     {
                         "FunctionArn": "arn:aws:lambda:::function:GGStreamManager:1",
@@ -247,43 +351,44 @@ def create_fn(cfg):
                     }
                 ]
             },
-            Name=f"fd-{cfg['DEF_UNIQUE_KEY']}",
+            Name=f"fd-{key}",
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def create_sub_defs(cfg, subs_to_make):
-    client = boto3.client('greengrass')
-    subs = []
-    for name, src, subject, tgt in subs_to_make:
-        subs.append(
-            {
-                'Id': f"sub-{cfg['DEF_UNIQUE_KEY']}-{name}",
-                'Source': src,
-                'Subject': subject,
-                'Target': tgt
-            }
-        )
+    client = get_client('greengrass')
+    key = cfg['DEF_UNIQUE_KEY']
+    subs = [
+        {
+            'Id': f"sub-{key}-{name}",
+            'Source': src,
+            'Subject': subject,
+            'Target': tgt
+        }
+        for name, src, subject, tgt in subs_to_make
+    ]
     try:
-        logger.info(f"Creating subscription {name}")
+        logger.info("Creating subscriptions %s", [sub['Id'] for sub in subs])
         response = client.create_subscription_definition(
+            AmznClientToken=client_token('sub'),
             InitialVersion={
                 'Subscriptions': subs
             },
-            Name=f"sub-{cfg['DEF_UNIQUE_KEY']}-{name}"
+            Name=f"sub-{key}"
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def create_group_version(gg_group, rd_arn, fn_arn, sub_arn, log_arn, core_arn):
-    client = boto3.client('greengrass')
-    logger.info(f"Creating new group version")
+    client = get_client('greengrass')
+    logger.info("Creating new group version")
     try:
         response = client.create_group_version(
             CoreDefinitionVersionArn=core_arn,
@@ -294,51 +399,51 @@ def create_group_version(gg_group, rd_arn, fn_arn, sub_arn, log_arn, core_arn):
             LoggerDefinitionVersionArn=log_arn
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def delete_fs_resource(id):
-    client = boto3.client('greengrass')
+    client = get_client('greengrass')
     try:
-        logger.info(f"Deleting file system resource")
+        logger.info("Deleting file system resource")
         response = client.delete_resource_definition(
             ResourceDefinitionId=id
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def delete_fn(id):
-    client = boto3.client('greengrass')
+    client = get_client('greengrass')
     try:
-        logger.info(f"Deleting lambda fn")
+        logger.info("Deleting lambda fn")
         response = client.delete_function_definition(
             FunctionDefinitionId=id
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def delete_sub_def(id):
-    client = boto3.client('greengrass')
+    client = get_client('greengrass')
     try:
-        logger.info(f"Deleting subscription {id}")
+        logger.info("Deleting subscription %s", id)
         response = client.delete_subscription_definition(
             SubscriptionDefinitionId=id
         )
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
 
 
 def reset_deployments(gg_group):
-    client = boto3.client('greengrass')
-    logger.info(f"resetting deployments")
+    client = get_client('greengrass')
+    logger.info("resetting deployments")
 
     try:
         response = client.reset_deployments(
@@ -346,110 +451,113 @@ def reset_deployments(gg_group):
             Force=True
         )
         return response
-    except Exception as e:
-        logger.error(e)
-        return None
-
-
-def get_cores(cfg):
-    client = boto3.client('greengrass')
-    logger.info(f"getting cores")
-    try:
-        response = client.list_core_definitions()
-        return response['Definitions']
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def get_core_defs(id):
-    client = boto3.client('greengrass')
-    logger.info(f"getting core def versions")
+    client = get_client('greengrass')
+    logger.info("getting core def versions")
     try:
-        response = client.list_core_definition_versions(
-            CoreDefinitionId=id
-        )
-        return response['Versions']
-    except Exception as e:
-        logger.error(e)
+        return paginate(client, 'list_core_definition_versions', 'Versions', CoreDefinitionId=id)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def delete_group(gg_group):
-    client = boto3.client('greengrass')
-    logger.info(f"deleting group")
+    client = get_client('greengrass')
+    logger.info("deleting group")
     try:
         response = client.delete_group(
             GroupId=gg_group['Id']
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
+def cleanup_principal(thing_name, arn):
+    """Detach and delete one certificate of a thing, returning the names of its policies."""
+    iot_client = get_client('iot')
+    policy_names = set()
+    cert_id = arn.split('/')[1]
+    logger.info("  arn: %s cert_id: %s", arn, cert_id)
+
+    iot_client.detach_thing_principal(thingName=thing_name, principal=arn)
+    logger.info("  DETACH THING: %s", thing_name)
+
+    iot_client.update_certificate(certificateId=cert_id, newStatus='INACTIVE')
+    logger.info("  INACTIVE: %s", cert_id)
+
+    r_policies = iot_client.list_principal_policies(principal=arn)
+    # logger.info("    r_policies: {}".format(r_policies))
+
+    for pol in r_policies['policies']:
+        pol_name = pol['policyName']
+        logger.info("    pol_name: %s", pol_name)
+        policy_names.add(pol_name)
+        iot_client.detach_policy(policyName=pol_name,target=arn)
+        logger.info("    DETACH POL: %s", pol_name)
+
+    iot_client.delete_certificate(certificateId=cert_id,forceDelete=True)
+    logger.info("  DEL CERT: %s", cert_id)
+    return policy_names
+
+
 def delete_thing(thing_name):
     # https://github.com/aws-samples/aws-iot-device-management-workshop/blob/master/bin/clean-up.py
-    policy_names = {}
-    iot_client = boto3.client('iot')
+    policy_names = set()
+    iot_client = get_client('iot')
     try:
         r_principals = iot_client.list_thing_principals(thingName=thing_name)
-    except Exception as e:
-        logger.error("ERROR listing thing principals: {}".format(e))
+    except ClientError as e:
+        logger.error("ERROR listing thing principals: %s", e)
         r_principals = {'principals': []}
 
     # logger.info("r_principals: {}".format(r_principals))
-    for arn in r_principals['principals']:
-        cert_id = arn.split('/')[1]
-        logger.info("  arn: {} cert_id: {}".format(arn, cert_id))
-
-        r_detach_thing = iot_client.detach_thing_principal(thingName=thing_name, principal=arn)
-        logger.info("  DETACH THING: {}".format(r_detach_thing))
-
-        r_upd_cert = iot_client.update_certificate(certificateId=cert_id, newStatus='INACTIVE')
-        logger.info("  INACTIVE: {}".format(r_upd_cert))
-
-        r_policies = iot_client.list_principal_policies(principal=arn)
-        # logger.info("    r_policies: {}".format(r_policies))
-
-        for pol in r_policies['policies']:
-            pol_name = pol['policyName']
-            logger.info("    pol_name: {}".format(pol_name))
-            policy_names[pol_name] = 1
-            r_detach_pol = iot_client.detach_policy(policyName=pol_name,target=arn)
-            logger.info("    DETACH POL: {}".format(r_detach_pol))
+    # Each certificate is independent, so tear them down concurrently
+    if r_principals['principals']:
+        with ThreadPoolExecutor(max_workers=min(16, len(r_principals['principals']))) as ex:
+            for names in ex.map(partial(cleanup_principal, thing_name), r_principals['principals']):
+                policy_names.update(names)
 
-        r_del_cert = iot_client.delete_certificate(certificateId=cert_id,forceDelete=True)
-        logger.info("  DEL CERT: {}".format(r_del_cert))
-
-    r_del_thing = iot_client.delete_thing(thingName=thing_name)
-    logger.info("  DELETE THING: {}\n".format(r_del_thing))
+    iot_client.delete_thing(thingName=thing_name)
+    logger.info("  DELETE THING: %s", thing_name)
 
     for p in policy_names:
-        logger.info("DELETE policy: {}".format(p))
+        logger.info("DELETE policy: %s", p)
         try:
-            r_del_pol = iot_client.delete_policy(policyName=p)
-            logger.info("r_del_pol: {}".format(r_del_pol))
-        except Exception as e:
-            logger.error("ERROR: {}".format(e))
+            iot_client.delete_policy(policyName=p)
+        except ClientError as e:
+            logger.error("ERROR: %s", e)
 
 
-def delete_things(thing_arns):
-    iot_client = boto3.client('iot')
+def get_thing_names():
+    """Map every IoT thing ARN in the account to its name."""
+    iot_client = get_client('iot')
     try:
-        if len(thing_arns) > 0:
-            list_things_response = iot_client.list_things()
-            if 'things' in list_things_response:
-                for thing in list_things_response['things']:
-                    if thing['thingArn'] in thing_arns:
-                        logger.info(f"deleting thingName {thing['thingName']}")
-                        delete_thing(thing['thingName'])
-    except Exception as e:
-        logger.error(e)
+        return {thing['thingArn']: thing['thingName'] for thing in paginate(iot_client, 'list_things', 'things')}
+    except ClientError as e:
+        log_error(e)
+        return {}
+
+
+def delete_things(thing_arns, arn_to_name):
+    try:
+        thing_names = [arn_to_name[arn] for arn in thing_arns if arn in arn_to_name]
+        logger.info("deleting thingNames %s", thing_names)
+        if thing_names:
+            with ThreadPoolExecutor(max_workers=min(16, len(thing_names))) as ex:
+                list(ex.map(delete_thing, thing_names))
+    except ClientError as e:
+        log_error(e)
 
 
 def get_core_thing_arns(core_def):
-    gg_client = boto3.client('greengrass')
+    gg_client = get_client('greengrass')
     response = []
     try:
         core_def_version_response = gg_client.get_core_definition_version(
@@ -457,18 +565,18 @@ def get_core_thing_arns(core_def):
             CoreDefinitionVersionId=core_def['Version']
         )
         if 'Definition' in core_def_version_response:
-            logger.info(core_def_version_response)
+            logger.info("Got core definition version %s", core_def_version_response['Arn'])
             response = [c['ThingArn'] for c in core_def_version_response['Definition']['Cores']]
 
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return response
 
 
-def delete_core_thing(core_def):
-    gg_client = boto3.client('greengrass')
-    iot_client = boto3.client('iot')
+def delete_core_thing(core_def, arn_to_name):
+    gg_client = get_client('greengrass')
+    iot_client = get_client('iot')
     response = []
     try:
         core_def_version_response = gg_client.get_core_definition_version(
@@ -476,152 +584,177 @@ def delete_core_thing(core_def):
             CoreDefinitionVersionId=core_def['Version']
         )
         if 'Definition' in core_def_version_response:
-            logger.info(core_def_version_response)
+            logger.info("Got core definition version %s", core_def_version_response['Arn'])
             core_thing_arns = [c['ThingArn'] for c in core_def_version_response['Definition']['Cores']]
             if len(core_thing_arns) > 0:
-                logger.info(f"found core_thing_arns {core_thing_arns}")
-                list_things_response = iot_client.list_things()
-                if 'things' in list_things_response:
-                    for thing in list_things_response['things']:
-                        if thing['thingArn'] in core_thing_arns:
-                            logger.info(f"deleting thingName {thing['thingName']}")
-                            iot_client.delete_thing(
-                                thingName=thing['thingName']
-                            )
+                logger.info("found core_thing_arns %s", core_thing_arns)
+                for arn in core_thing_arns:
+                    if arn in arn_to_name:
+                        logger.info("deleting thingName %s", arn_to_name[arn])
+                        iot_client.delete_thing(
+                            thingName=arn_to_name[arn]
+                        )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def delete_core_definition(core_def):
-    client = boto3.client('greengrass')
-    logger.info(f"deleting core definition")
+    client = get_client('greengrass')
+    logger.info("deleting core definition")
     try:
 
         response = client.delete_core_definition(
             CoreDefinitionId=core_def['Id']
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
+        return None
+
+
+def list_definitions(cfg, limit=None, kinds=(get_resource_definitions, get_fn_definitions, get_sub_definitions, get_log_definitions)):
+    """Fetch our definitions of each kind concurrently, by default resource, function, subscription and logger."""
+    with ThreadPoolExecutor(max_workers=len(kinds)) as ex:
+        futures = [ex.submit(f, cfg, limit) for f in kinds]
+        return [f.result() for f in futures]
+
+
+def map_groups(fn, gg_groups):
+    """Run fn for every group on a bounded thread pool and return the results in order."""
+    if not gg_groups:
+        return []
+    with ThreadPoolExecutor(max_workers=min(16, len(gg_groups))) as ex:
+        return list(ex.map(fn, gg_groups))
+
+
+def cleanup_group(cfg, arn_to_name, group):
+    # gg_setup records each group's core definition version, which saves looking it up again
+    core_arn = cfg.get('CORE_DEF_VERSION_ARNS', {}).get(group['Id'])
+    if core_arn is None:
+        group_version_arn, group_version_id = get_latest_group_version(group['Id'])
+        core_arn = get_group_definition(group['Id'], group_version_id).get('CoreDefinitionVersionArn')
+    if core_arn is not None:
+        # The version ARN ends in .../cores/<core definition id>/versions/<version id>,
+        # so only that core definition's versions need listing
+        core_def_id = core_arn.split('/')[-3]
+        for core_def in get_core_defs(core_def_id) or []:
+            if core_arn in core_def['Arn']:
+                thing_arns = get_core_thing_arns(core_def)
+                delete_core_definition(core_def)
+                delete_things(thing_arns, arn_to_name)
+    delete_group(group)
+
+
+def lookup_group_definition(group):
+    group_version_arn, group_version_id = get_latest_group_version(group['Id'])
+    return get_group_definition(group['Id'], group_version_id)
+
+
+def deploy_group(cfg, rd_arn, fn_arn, sub_arn, log_arn, group):
+    group_def = lookup_group_definition(group)
+    if 'CoreDefinitionVersionArn' not in group_def:
+        logger.error("Group %s has no core definition yet, skipping it", group['Id'])
         return None
 
+    gv = create_group_version(group, rd_arn, fn_arn, sub_arn, log_arn, group_def['CoreDefinitionVersionArn'])
+
+    logger.info("Starting deployment for group %s", group['Id'])
+    client = get_client('greengrass')
+    try:
+        response = client.create_deployment(
+            DeploymentType='NewDeployment',
+            GroupId=group['Id'],
+            GroupVersionId=gv['Version']
+        )
+    except ClientError as e:
+        log_error(e)
+    return group_def['CoreDefinitionVersionArn']
+
+
+def find_existing(defs, kind):
+    """Return the first of our existing definitions, or None if there are none yet."""
+    if defs:
+        logger.info("%s already exists", kind)
+        return defs[0]
+    return None
+
+
+def find_or_create(defs, kind, create, *args):
+    return find_existing(defs, kind) or create(*args)
+
 
 def gg_cleanup(cfg, gg_groups):
-    for group in gg_groups:
-        reset_deployments(group)
+    map_groups(reset_deployments, gg_groups)
 
-    sub_defs = get_sub_definitions(cfg)
+    # The listings only hold definitions named with our key. Logger definitions aren't
+    # deleted, so they aren't listed either.
+    resource_defs, fn_defs, sub_defs = list_definitions(cfg, kinds=(get_resource_definitions, get_fn_definitions, get_sub_definitions))
     for s in sub_defs:
-        if cfg['DEF_UNIQUE_KEY'] in s['Name']:
-            delete_sub_def(s['Id'])
+        delete_sub_def(s['Id'])
 
-    fn_defs = get_fn_definitions(cfg)
     for f in fn_defs:
-        if cfg['DEF_UNIQUE_KEY'] in f['Name']:
-            delete_fn(f['Id'])
+        delete_fn(f['Id'])
 
-    resource_defs = get_resource_definitions(cfg)
     for r in resource_defs:
-        if cfg['DEF_UNIQUE_KEY'] in r['Name']:
-            delete_fs_resource(r['Id'])
-
-    for group in gg_groups:
-        group_version_arn, group_version_id = get_latest_group_version(cfg, group)
-        group_def = get_group_definition(cfg, group, group_version_id)
-        if 'CoreDefinitionVersionArn' in group_def:
-            for core in get_cores(cfg):
-                for core_def in get_core_defs(core['Id']):
-                    if group_def['CoreDefinitionVersionArn'] in core_def['Arn']:
-                        thing_arns = get_core_thing_arns(core_def)
-                        delete_core_definition(core_def)
-                        delete_things(thing_arns)
-        delete_group(group)
+        delete_fs_resource(r['Id'])
+
+    # One scan of the account's things serves every group
+    arn_to_name = get_thing_names()
+    map_groups(partial(cleanup_group, cfg, arn_to_name), gg_groups)
+    save_cfg_entry('CORE_DEF_VERSION_ARNS', None)
 
 
 def gg_setup(cfg, gg_groups):
-    for group in gg_groups:
-        register_role(cfg, group)
+    # The groups' current versions don't depend on our definitions, so look them up
+    # in the background while those are found or created; deploy_group then hits the cache
+    prefetch = ThreadPoolExecutor(max_workers=1)
+    lookups = prefetch.submit(map_groups, lookup_group_definition, gg_groups)
 
-    resource_defs = get_resource_definitions(cfg)
-    exists = False
-    for r in resource_defs:
-        if cfg['DEF_UNIQUE_KEY'] in r['Name']:
-            logger.info("FS resource already exists")
-            fs_resource = r
-            exists = True
-            break
-    if exists == False:
-        fs_resource = create_fs_resource(cfg)
+    map_groups(partial(register_role, cfg), gg_groups)
 
-    fn_defs = get_fn_definitions(cfg)
-    exists = False
-    for f in fn_defs:
-        if cfg['DEF_UNIQUE_KEY'] in f['Name']:
-            logger.info("Fn already exists")
-            fn_resource = f
-            exists = True
-            break
-    if exists == False:
-        fn_resource = create_fn(cfg)
+    # Only the first existing definition of each kind is reused
+    resource_defs, fn_defs, sub_defs, log_defs = list_definitions(cfg, limit=1)
 
-    sub_defs = get_sub_definitions(cfg)
     subs_to_make = [('fit', cfg['GgFnArn'], 'fit/client/+/sent', 'cloud'),
         ('evaluate', cfg['GgFnArn'], 'evaluate/client/+/sent','cloud'),
         ('parameters', cfg['GgFnArn'], 'parameters/client/+/sent','cloud'),
         ('set', cfg['GgFnArn'], 'set/client/+/sent','cloud'),
         ('commands', 'cloud', 'commands/client/+/update', cfg['GgFnArn']),
+        ('responses', cfg['GgFnArn'], 'responses/client/+/+','cloud'),
         ('heartbeat', cfg['GgFnArn'], 'flower/clients/#','cloud')]
-    exists = False
-    for s in sub_defs:
-        if cfg['DEF_UNIQUE_KEY'] in s['Name']:
-            logger.info(f"Subscription already exists")
-            sub_resource = s
-            exists = True
-            break
-    if exists == False:
-        sub_resource = create_sub_defs(cfg, subs_to_make)
-
-    exists = False
-    log_defs = get_log_definitions(cfg)
-    for log_def in log_defs:
-        if 'Name' in log_def and cfg['DEF_UNIQUE_KEY'] in log_def['Name']:
-            log_def_resource = log_def
-            exists = True
-            break
-    if not exists:
-        log_def_resource = create_log_def(cfg)
 
-    for group in gg_groups:
-
-        group_version_arn, group_version_id = get_latest_group_version(cfg, group)
-        group_def = get_group_definition(cfg, group, group_version_id)
-
-        gv = create_group_version(group, fs_resource['LatestVersionArn'], fn_resource['LatestVersionArn'], sub_resource['LatestVersionArn'], log_def_resource['LatestVersionArn'], group_def['CoreDefinitionVersionArn'])
-
-        logger.info(f"Starting deployment for group {group['Id']}")
-        client = boto3.client('greengrass')
-        try:
-            response = client.create_deployment(
-                DeploymentType='NewDeployment',
-                GroupId=group['Id'],
-                GroupVersionId=gv['Version']
-            )
-        except Exception as e:
-            logger.error(e)
+    # The definitions only come together in the group version, so create any missing ones at once
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        futures = [
+            ex.submit(find_or_create, resource_defs, "FS resource", create_fs_resource, cfg),
+            ex.submit(find_or_create, fn_defs, "Fn", create_fn, cfg),
+            ex.submit(find_or_create, sub_defs, "Subscription", create_sub_defs, cfg, subs_to_make),
+            ex.submit(find_or_create, log_defs, "Logger definition", create_log_def, cfg)
+        ]
+        fs_resource, fn_resource, sub_resource, log_def_resource = [f.result() for f in futures]
+    if not all((fs_resource, fn_resource, sub_resource, log_def_resource)):
+        logger.error("Could not find or create every definition, not deploying the groups")
+        prefetch.shutdown()
+        return
+
+    lookups.result()
+    prefetch.shutdown()
+    core_arns = map_groups(partial(deploy_group, cfg, fs_resource['LatestVersionArn'], fn_resource['LatestVersionArn'], sub_resource['LatestVersionArn'], log_def_resource['LatestVersionArn']), gg_groups)
+    save_cfg_entry('CORE_DEF_VERSION_ARNS', {group['Id']: arn for group, arn in zip(gg_groups, core_arns)})
 
 
 def get_gg_groups(cfg):
-    client = boto3.client('greengrass')
+    client = get_client('greengrass')
     try:
-        response = client.list_groups()
-        if 'Groups' in response:
-            groups = [group for group in response['Groups'] if cfg['ProjectTag'] in group['Name']]
-        logger.info(f"Found groups {[group['Name'] for group in groups]}")
+        # The cores name their groups "<ProjectTag>-group-<uuid>" (see cfn/flower-demo.yaml)
+        prefix = f"{cfg['ProjectTag']}-group-"
+        groups = paginate(client, 'list_groups', 'Groups', match=lambda group: group['Name'].startswith(prefix))
+        logger.info("Found groups %s", [group['Name'] for group in groups])
         return groups
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return []
 
 
@@ -633,9 +766,17 @@ if __name__ == "__main__":
     logger.setLevel(logging.INFO)
     logger_ch = logging.StreamHandler()
     logger_ch.setLevel(logging.INFO)
-    logger_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(lineno)d - %(message)s')
+    # Second resolution is plenty for these runs; an explicit datefmt skips the millisecond
+    # formatting of every record (default_msec_format = None needs Python 3.9)
+    logger_formatter = logging.Formatter('{asctime} - {name} - {levelname} - {message}', datefmt='%Y-%m-%d %H:%M:%S', style='{')
     logger_ch.setFormatter(logger_formatter)
-    logger.addHandler(logger_ch)
+    # QueueHandler still formats each record on the thread that logs it; only the write, and
+    # the StreamHandler lock around it, move to the one listener thread
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, logger_ch)
+    log_listener.start()
+    atexit.register(log_listener.stop)
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--clean", action="store_true",
@@ -643,7 +784,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     cfg = read_cfg()
-    logger.info(f"Found configuration data: {cfg}")
+    logger.info("Found configuration data: %s", cfg)
 
     gg_groups = get_gg_groups(cfg)
 
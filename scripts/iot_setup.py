@@ -1,91 +1,86 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import logging
+import logging.handlers
 import json
 import argparse
-
-
+import atexit
+import queue
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import botocore.session
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Keep connections open across the setup/cleanup calls and let botocore back off on throttling
+boto_config = Config(max_pool_connections=50, tcp_keepalive=True, retries={'mode': 'adaptive', 'max_attempts': 10})
+# One session for the whole run, so credentials are resolved once, and one
+# client per service shared by every helper below. Only low-level clients are used,
+# so the session comes straight from botocore rather than boto3.
+session = botocore.session.get_session()
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name):
+    # Sessions aren't thread safe, so clients are only ever built under the lock
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = session.create_client(name, config=boto_config)
+        return _clients[name]
+
+
+def log_error(e):
+    """Log a failed call, but let throttling that outlasted the client's retries propagate."""
+    if e.response['Error']['Code'] in ('ThrottlingException', 'TooManyRequestsException'):
+        raise e
+    logger.error(e)
+
+
+# describe_stacks is heavily rate limited, so the config and stack outputs are only read once per run
+@lru_cache(maxsize=1)
 def read_cfg():
-    client = boto3.client('cloudformation')
-
-    with open('iot_setup.json', 'r') as F:
-        cfg = json.load(F)
+    with open('iot_setup.json', 'rb') as F:
+        cfg = loads(F.read())
+
+    # Every resource name derives from the unique key, so build them once here
+    key = cfg['DEF_UNIQUE_KEY']
+    cfg.update(
+        DatastoreName=f"ds_{key}",
+        ChannelName=f"ch_{key}",
+        PipelineName=f"pl_{key}",
+        DatasetName=f"dataset_{key}",
+        DatasetActionName=f"dt_act_{key}"
+    )
 
     try:
-        response = client.describe_stacks(
+        response = get_client('cloudformation').describe_stacks(
             StackName=cfg['STACK_NAME'],
         )
         if 'Stacks' in response and response['Stacks'][0]['StackName'] == cfg['STACK_NAME']:
-            for output in response['Stacks'][0]['Outputs']:
-                cfg[output['OutputKey']] = output['OutputValue']
-        logger.info(cfg)
+            cfg.update({o['OutputKey']: o['OutputValue'] for o in response['Stacks'][0]['Outputs']})
         return cfg
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
-def get_rules(cfg):
-    client = boto3.client('iot')
-    try:
-        response = client.list_topic_rules()
-        logger.info(f"Got {len(response['rules'])} rules")
-        return response['rules']
-    except Exception as e:
-        logger.error(e)
-        return []
-
-def get_datastores(cfg):
-    client = boto3.client('iotanalytics')
-    try:
-        response = client.list_datastores()
-        logger.info(f"Got {len(response['datastoreSummaries'])} data stores")
-        return response['datastoreSummaries']
-    except Exception as e:
-        logger.error(e)
-        return []
-
-def get_channels(cfg):
-    client = boto3.client('iotanalytics')
-    try:
-        response = client.list_channels()
-        logger.info(f"Got {len(response['channelSummaries'])} channels")
-        return response['channelSummaries']
-    except Exception as e:
-        logger.error(e)
-        return []
-
-def get_pipelines(cfg):
-    client = boto3.client('iotanalytics')
-    try:
-        response = client.list_pipelines()
-        logger.info(f"Got {len(response['pipelineSummaries'])} pipelines")
-        return response['pipelineSummaries']
-    except Exception as e:
-        logger.error(e)
-        return []
-
-def get_datasets(cfg):
-    client = boto3.client('iotanalytics')
-    try:
-        response = client.list_datasets()
-        logger.info(f"Got {len(response['datasetSummaries'])} data sets")
-        return response['datasetSummaries']
-    except Exception as e:
-        logger.error(e)
-        return []
-
 def create_dataset(cfg, datastore):
-    client = boto3.client('iotanalytics')
+    client = get_client('iotanalytics')
     try:
-        logger.info(f"Creating dataset")
+        logger.info("Creating dataset")
         response = client.create_dataset(
-            datasetName=f"dataset_{cfg['DEF_UNIQUE_KEY']}",
+            datasetName=cfg['DatasetName'],
             actions=[
                 {
-                    'actionName': f"dt_act_{cfg['DEF_UNIQUE_KEY']}",
+                    'actionName': cfg['DatasetActionName'],
                     'queryAction': {
                         'sqlQuery': f"SELECT DISTINCT client, MAX(time) FROM {datastore} WHERE time > to_unixtime(current_timestamp - interval '1' hour)  GROUP BY client ORDER BY MAX(time), client DESC LIMIT 10"
                     },
@@ -104,69 +99,74 @@ def create_dataset(cfg, datastore):
             },
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except client.exceptions.ResourceAlreadyExistsException:
+        name = cfg['DatasetName']
+        logger.info("%s already exists", name)
+        return {'datasetName': name}
+    except ClientError as e:
+        log_error(e)
         return None
 
-def create_rule_for_analytics(cfg, name, sql, ch_name):
-    client = boto3.client('iot')
-    try:
-        logger.info(f"Creating topic rule {name}")
-        client.create_topic_rule(
-            ruleName=f"rule_{name}_{cfg['DEF_UNIQUE_KEY']}",
-            topicRulePayload={
-                'sql': sql,
-                'actions': [
-                    {
-                        'iotAnalytics': {
-                            'channelName': ch_name,
-                            'batchMode': False,
-                            'roleArn': cfg['IotRoleArn']
-                        },
-                    }
-                ],
-                'ruleDisabled': False
-            }
+def analytics_action(cfg, ch_name):
+    return {
+        'iotAnalytics': {
+            'channelName': ch_name,
+            'batchMode': False,
+            'roleArn': cfg['IotRoleArn']
+        },
+    }
+
+
+# The parts of the DynamoDB rule action that are the same for every method
+DYNAMODB_ACTION = {
+    'operation': 'INSERT',
+    'hashKeyField': 'client',
+    'hashKeyValue': '${client}',
+    'hashKeyType': 'STRING',
+    'rangeKeyField': 'type',
+    'rangeKeyType': 'STRING',
+    'payloadField': 'path'
+}
+
+
+def dynamodb_action(cfg, method):
+    return {
+        'dynamoDB': dict(
+            DYNAMODB_ACTION,
+            tableName=cfg['TableName'],
+            roleArn=cfg['IotRoleArn'],
+            rangeKeyValue=method
         )
-    except Exception as e:
-        logger.error(e)
+    }
+
+
+def rule_name(cfg, name):
+    return f"rule_{name}_{cfg['DEF_UNIQUE_KEY']}"
+
 
-def create_rule(cfg, name, sql, method):
-    client = boto3.client('iot')
+def create_rule(cfg, name, sql, action):
+    client = get_client('iot')
     try:
-        logger.info(f"Creating topic rule {name}")
+        logger.info("Creating topic rule %s", name)
         client.create_topic_rule(
-            ruleName=f"rule_{name}_{cfg['DEF_UNIQUE_KEY']}",
+            ruleName=rule_name(cfg, name),
             topicRulePayload={
                 'sql': sql,
-                'actions': [
-                    {
-                        'dynamoDB': {
-                            'tableName': cfg['TableName'],
-                            'roleArn': cfg['IotRoleArn'],
-                            'operation': 'INSERT',
-                            'hashKeyField': 'client',
-                            'hashKeyValue': '${client}',
-                            'hashKeyType': 'STRING',
-                            'rangeKeyField': 'type',
-                            'rangeKeyValue': method,
-                            'rangeKeyType': 'STRING',
-                            'payloadField': 'path'
-                        }
-                    }
-                ],
+                'actions': [action],
                 'ruleDisabled': False
             }
         )
-    except Exception as e:
-        logger.error(e)
+    except client.exceptions.ResourceAlreadyExistsException:
+        logger.info("Topic rule %s already exists", name)
+    except ClientError as e:
+        log_error(e)
 
 def create_datastore(cfg):
-    client = boto3.client('iotanalytics')
+    client = get_client('iotanalytics')
     try:
-        logger.info(f"Creating datastore")
+        logger.info("Creating datastore")
         response = client.create_datastore(
-            datastoreName=f"ds_{cfg['DEF_UNIQUE_KEY']}",
+            datastoreName=cfg['DatastoreName'],
             datastoreStorage={
                 'serviceManagedS3': {} ,
             },
@@ -179,16 +179,20 @@ def create_datastore(cfg):
             }
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except client.exceptions.ResourceAlreadyExistsException:
+        name = cfg['DatastoreName']
+        logger.info("%s already exists", name)
+        return {'datastoreName': name}
+    except ClientError as e:
+        log_error(e)
         return None
 
 def create_channel(cfg):
-    client = boto3.client('iotanalytics')
+    client = get_client('iotanalytics')
     try:
-        logger.info(f"Creating channel")
+        logger.info("Creating channel")
         response = client.create_channel(
-            channelName=f"ch_{cfg['DEF_UNIQUE_KEY']}",
+            channelName=cfg['ChannelName'],
             channelStorage={
                 'serviceManagedS3': {}
             },
@@ -198,16 +202,20 @@ def create_channel(cfg):
             }
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except client.exceptions.ResourceAlreadyExistsException:
+        name = cfg['ChannelName']
+        logger.info("%s already exists", name)
+        return {'channelName': name}
+    except ClientError as e:
+        log_error(e)
         return None
 
 def create_pipeline(cfg, ch, ds):
-    client = boto3.client('iotanalytics')
+    client = get_client('iotanalytics')
     try:
-        logger.info(f"Creating pipeline")
+        logger.info("Creating pipeline")
         response = client.create_pipeline(
-            pipelineName=f"pl_{cfg['DEF_UNIQUE_KEY']}",
+            pipelineName=cfg['PipelineName'],
             pipelineActivities=[
                 {
                     'channel': {
@@ -225,15 +233,19 @@ def create_pipeline(cfg, ch, ds):
             ]
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except client.exceptions.ResourceAlreadyExistsException:
+        name = cfg['PipelineName']
+        logger.info("%s already exists", name)
+        return {'pipelineName': name}
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def create_ssm_param(cfg, value):
-    client = boto3.client('ssm')
+    client = get_client('ssm')
     try:
-        logger.info(f"creating ssm param")
+        logger.info("creating ssm param")
         response = client.put_parameter(
             Name=cfg['DatasetParam'],
             Value=value,
@@ -242,178 +254,152 @@ def create_ssm_param(cfg, value):
             DataType='text'
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def delete_ssm_param(cfg):
-    client = boto3.client('ssm')
+    client = get_client('ssm')
     try:
-        logger.info(f"deleting ssm param")
+        logger.info("deleting ssm param")
         response = client.delete_parameter(
             Name=cfg['DatasetParam']
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except client.exceptions.ParameterNotFound:
+        logger.info("SSM param is already gone")
+        return None
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def delete_dataset(cfg):
-    client = boto3.client('iotanalytics')
+    client = get_client('iotanalytics')
     try:
-        logger.info(f"Deleting dataset")
+        logger.info("Deleting dataset")
         response = client.delete_dataset(
-            datasetName=f"dataset_{cfg['DEF_UNIQUE_KEY']}"
+            datasetName=cfg['DatasetName']
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except client.exceptions.ResourceNotFoundException:
+        logger.info("Dataset is already gone")
+        return None
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def delete_rule(cfg, name):
-    client = boto3.client('iot')
+    client = get_client('iot')
     try:
-        logger.info(f"Deleting topic rule {name}")
+        logger.info("Deleting topic rule %s", name)
         response = client.delete_topic_rule(
-            ruleName=f"rule_{name}_{cfg['DEF_UNIQUE_KEY']}",
+            ruleName=rule_name(cfg, name),
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except ClientError as e:
+        # DeleteTopicRule reports a rule that doesn't exist as UnauthorizedException
+        if e.response['Error']['Code'] == 'UnauthorizedException':
+            logger.info("Topic rule %s is already gone (or not ours to delete)", name)
+        else:
+            log_error(e)
         return None
 
 
 def delete_channel(cfg):
-    client = boto3.client('iotanalytics')
+    client = get_client('iotanalytics')
     try:
-        logger.info(f"Deleting channel")
+        logger.info("Deleting channel")
         response = client.delete_channel(
-            channelName=f"ch_{cfg['DEF_UNIQUE_KEY']}"
+            channelName=cfg['ChannelName']
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except client.exceptions.ResourceNotFoundException:
+        logger.info("Channel is already gone")
+        return None
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def delete_pipeline(cfg):
-    client = boto3.client('iotanalytics')
+    client = get_client('iotanalytics')
     try:
-        logger.info(f"deleting pipeline")
+        logger.info("deleting pipeline")
         response = client.delete_pipeline(
-            pipelineName=f"pl_{cfg['DEF_UNIQUE_KEY']}"
+            pipelineName=cfg['PipelineName']
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except client.exceptions.ResourceNotFoundException:
+        logger.info("Pipeline is already gone")
+        return None
+    except ClientError as e:
+        log_error(e)
         return None
 
 
 def delete_datastore(cfg):
-    client = boto3.client('iotanalytics')
+    client = get_client('iotanalytics')
     try:
-        logger.info(f"Deleting datastore")
+        logger.info("Deleting datastore")
         response = client.delete_datastore(
-            datastoreName=f"ds_{cfg['DEF_UNIQUE_KEY']}"
+            datastoreName=cfg['DatastoreName']
         )
         return response
-    except Exception as e:
-        logger.error(e)
+    except client.exceptions.ResourceNotFoundException:
+        logger.info("Datastore is already gone")
+        return None
+    except ClientError as e:
+        log_error(e)
         return None
 
 def iot_setup(cfg):
-    rules_to_make = [ ('get', "SELECT * FROM 'parameters/client/+/sent'", 'get'),
-        ('set', "SELECT * FROM 'set/client/+/sent'", 'set'),
-        ('fit', "SELECT * FROM 'fit/client/+/sent'", 'fit'),
-        ('evaluate', "SELECT * FROM 'evaluate/client/+/sent'", 'evaluate')]
-    rules = get_rules(cfg)
-    for rule_name, sql, method in rules_to_make:
-        exists = False
-        for r in rules:
-            if cfg['DEF_UNIQUE_KEY'] in r['ruleName'] and rule_name in r['ruleName']:
-                logger.info(f"Rule {rule_name} already exists")
-                exists = True
-                break
-        if exists == False:
-            create_rule(cfg, rule_name, sql, method)
-
-    # data store
-    ds = get_datastores(cfg)
-    exists = False
-    for d in ds:
-        if cfg['DEF_UNIQUE_KEY'] in d['datastoreName']:
-            logger.info(f"Datastore already exists")
-            exists = True
-            datastore = d
-            break
-    if exists == False:
-        datastore = create_datastore(cfg)
-
-    # channel
-    ch = get_channels(cfg)
-    exists = False
-    for c in ch:
-        if cfg['DEF_UNIQUE_KEY'] in c['channelName']:
-            logger.info(f"Channel already exists")
-            exists = True
-            channel = c
-            break
-    if exists == False:
+    # Every name is deterministic and the create_* helpers treat "already exists" as
+    # success, so create directly instead of listing everything first
+    with ThreadPoolExecutor(max_workers=5) as ex:
+        # The response rules only feed DynamoDB, so create them while the analytics side is set up
+        rules_to_make = [ ('get', "SELECT * FROM 'parameters/client/+/sent'", 'get'),
+            ('set', "SELECT * FROM 'set/client/+/sent'", 'set'),
+            ('fit', "SELECT * FROM 'fit/client/+/sent'", 'fit'),
+            ('evaluate', "SELECT * FROM 'evaluate/client/+/sent'", 'evaluate')]
+        rule_futures = [ex.submit(create_rule, cfg, rule_name, sql, dynamodb_action(cfg, method))
+            for rule_name, sql, method in rules_to_make]
+
+        # data store and channel don't depend on each other
+        datastore_future = ex.submit(create_datastore, cfg)
         channel = create_channel(cfg)
+        datastore = datastore_future.result()
 
-    # pipeline
-    pl = get_pipelines(cfg)
-    exists = False
-    for p in pl:
-        if cfg['DEF_UNIQUE_KEY'] in p['pipelineName']:
-            logger.info(f"Pipeline already exists")
-            exists = True
-            break
-    if exists == False:
+        # pipeline
         create_pipeline(cfg, channel['channelName'], datastore['datastoreName'])
 
-    # rule
-    rules_to_make = [ ('heartbeat', "SELECT * FROM 'flower/clients/#'", channel['channelName'])]
-    for rule_name, sql, ch in rules_to_make:
-        exists = False
-        for r in rules:
-            if cfg['DEF_UNIQUE_KEY'] in r['ruleName'] and rule_name in r['ruleName']:
-                logger.info(f"Rule {rule_name} already exists")
-                exists = True
-                break
-        if exists == False:
-            create_rule_for_analytics(cfg, rule_name, sql, ch)
-
-    # data set
-    datasets = get_datasets(cfg)
-    exists = False
-    for dt in datasets:
-        if cfg['DEF_UNIQUE_KEY'] in dt['datasetName']:
-            logger.info(f"Dataset already exists")
-            dataset = dt
-            exists = True
-            break
-    if exists == False:
+        # heartbeats go to the analytics channel
+        rule_futures.append(ex.submit(create_rule, cfg, 'heartbeat', "SELECT * FROM 'flower/clients/#'", analytics_action(cfg, channel['channelName'])))
+
+        # data set
         dataset = create_dataset(cfg, datastore['datastoreName'])
 
-    create_ssm_param(cfg, dataset['datasetName'])
+        create_ssm_param(cfg, dataset['datasetName'])
 
+        for f in as_completed(rule_futures):
+            f.result()
 
-def iot_cleanup(cfg):
-    delete_dataset(cfg)
 
+def iot_cleanup(cfg):
     rules_to_delete = ['heartbeat', 'get', 'set', 'fit', 'evaluate']
-    for rule_name in rules_to_delete:
-        delete_rule(cfg, rule_name)
-
-    delete_pipeline(cfg)
-    delete_channel(cfg)
-    delete_datastore(cfg)
-
-    delete_ssm_param(cfg)
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        # The dataset, pipeline and heartbeat rule refer to the datastore and channel,
+        # so those two go in a second wave once everything else is gone
+        first_wave = [ex.submit(delete_rule, cfg, rule_name) for rule_name in rules_to_delete]
+        first_wave += [ex.submit(fn, cfg) for fn in (delete_dataset, delete_pipeline, delete_ssm_param)]
+        for f in as_completed(first_wave):
+            f.result()
+
+        second_wave = [ex.submit(delete_channel, cfg), ex.submit(delete_datastore, cfg)]
+        for f in as_completed(second_wave):
+            f.result()
 
 if __name__ == "__main__":
 
@@ -423,9 +409,17 @@ if __name__ == "__main__":
     logger.setLevel(logging.INFO)
     logger_ch = logging.StreamHandler()
     logger_ch.setLevel(logging.INFO)
-    logger_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(lineno)d - %(message)s')
+    # Second resolution is plenty for these runs; an explicit datefmt skips the millisecond
+    # formatting of every record (default_msec_format = None needs Python 3.9)
+    logger_formatter = logging.Formatter('{asctime} - {name} - {levelname} - {message}', datefmt='%Y-%m-%d %H:%M:%S', style='{')
     logger_ch.setFormatter(logger_formatter)
-    logger.addHandler(logger_ch)
+    # QueueHandler still formats each record on the thread that logs it; only the write, and
+    # the StreamHandler lock around it, move to the one listener thread
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, logger_ch)
+    log_listener.start()
+    atexit.register(log_listener.stop)
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--clean", action="store_true",
@@ -433,7 +427,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     cfg = read_cfg()
-    logger.info(f"Found configuration data: {cfg}")
+    logger.info("Found configuration data: %s", cfg)
 
     if args.clean:
         logger.info("deleting iot configuration")